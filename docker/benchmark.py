@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+""" Measure overhead of puppet_test.py itself.
+
+    Docker daemon is replaced by a fake Docker API served from this process, puppet
+    run by docker exec or by a stub ssh prints --output-lines lines of output, so the measured
+    time is spent in docker API round trips, subprocess spawns and report rendering
+    of the orchestrator only.
+"""
+import sys
+import os
+import re
+import json
+import struct
+import time
+import timeit
+import gzip
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import itertools
+import functools
+import yaml
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, TCPServer
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, TCPServer
+    from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import puppet_test
+
+BENCHMARKS = ['container', 'pool', 'report', 'endpoints']
+
+STUB_SSH = """#!/bin/sh
+# stub ssh for benchmark.py, the last argument is the remote command
+for command; do :; done
+case "$command" in
+  *"puppet apply"*)
+    i=0
+    while [ $i -lt ${BENCHMARK_OUTPUT_LINES:-100} ]; do
+      printf '\\033[0;36mDebug: /Stage[main]/Base/File[/tmp/file_%s]: benchmark output\\033[0m\\n' $i
+      i=$((i+1))
+    done
+    echo "Notice: /Stage[main]/Base/Package[strace]/ensure: created"
+    echo "Warning: benchmark warning" >&2
+    exit 2;;
+  *) exit 0;;
+esac
+"""
+
+class FakeDockerState:
+    """ Containers, images, exec instances and events of the fake docker daemon """
+    def __init__(self, images, output_lines):
+        self.containers = {}
+        self.execs = {}
+        self.output_lines = output_lines
+        self.images = dict(images)
+        self.events = []
+        self.calls = 0
+        self.stopped = False
+        self.lock = threading.Condition()
+        self.ids = itertools.count(1)
+
+    def add_event(self, container_id, status):
+        with self.lock:
+            self.events.append({'id': container_id, 'status': status, 'time': int(time.time())})
+            self.lock.notify_all()
+
+    def find(self, ref):
+        for container in list(self.containers.values()):
+            if container['Id'].startswith(ref) or container['Name'] == '/' + ref:
+                return container
+        return None
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """ Subset of the docker remote API used by puppet_test.py """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent at once, otherwise every keep-alive call waits for delayed ack
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # unix sockets have no TCP_NODELAY
+        self.disable_nagle_algorithm = self.server.address_family != socket.AF_UNIX
+        BaseHTTPRequestHandler.setup(self)
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=None, content_type='application/json'):
+        if body is None:
+            data = b''
+        elif content_type == 'application/json':
+            data = json.dumps(body).encode('utf-8')
+        else:
+            data = body
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def stream_events(self, state):
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        position = len(state.events)
+        while True:
+            with state.lock:
+                while position >= len(state.events) and not state.stopped:
+                    state.lock.wait(1)
+                if state.stopped:
+                    return
+                events = state.events[position:]
+                position = len(state.events)
+            for event in events:
+                data = json.dumps(event).encode('utf-8')
+                try:
+                    self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+                    self.wfile.flush()
+                except socket.error:
+                    return
+
+    def stream_exec(self, state, exec_instance):
+        """ Multiplexed output of the command, puppet prints the same as the stub ssh """
+        frames = []
+        if 'puppet apply' in ' '.join(exec_instance['Cmd']):
+            frames = [(1, ('\x1b[0;36mDebug: /Stage[main]/Base/File[/tmp/file_%d]: benchmark output\x1b[0m\n' % i).encode('utf-8'))
+                      for i in range(state.output_lines)]
+            frames.append((1, b'Notice: /Stage[main]/Base/Package[strace]/ensure: created\n'))
+            frames.append((2, b'Warning: benchmark warning\n'))
+            exec_instance['ExitCode'] = 2
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for (stream, data) in frames:
+            self.wfile.write(struct.pack('>BxxxL', stream, len(data)) + data)
+        self.close_connection = True
+
+    def route(self, method):
+        state = self.server.state
+        with state.lock:
+            state.calls += 1
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+
+        if path in ['/info', '/version']:
+            return self.send(200, {'Containers': len(state.containers), 'Version': '0.9'})
+        if path == '/events':
+            return self.stream_events(state)
+        if path == '/images/json':
+            name = (query.get('filter') or [None])[0]
+            return self.send(200, [{'Repository': image.split(':')[0], 'Tag': image.split(':')[1], 'Id': image_id}
+                                   for (image, image_id) in list(state.images.items())
+                                   if not name or image.split(':')[0] == name])
+        m = re.match(r'^/images/(.+)/json$', path)
+        if m:
+            image = m.group(1) if ':' in m.group(1) else m.group(1) + ':latest'
+            if image in state.images:
+                return self.send(200, {'id': state.images[image]})
+            return self.send(404, b'No such image', 'text/plain')
+        if path == '/commit' and method == 'POST':
+            self.read_body()
+            if not state.find(query['container'][0]):
+                return self.send(404, ('No such container: %s' % query['container'][0]).encode('utf-8'), 'text/plain')
+            image_id = '%064x' % next(state.ids)
+            with state.lock:
+                state.images['%s:%s' % (query['repo'][0], (query.get('tag') or ['latest'])[0])] = image_id
+            return self.send(201, {'Id': image_id})
+        if path == '/containers/create':
+            name = (query.get('name') or [None])[0]
+            config = self.read_body()
+            if name and state.find(name):
+                return self.send(409, b'Conflict', 'text/plain')
+            container_id = '%064x' % next(state.ids)
+            state.containers[container_id] = {'Id': container_id, 'Name': '/%s' % (name or container_id[:12]),
+                                              'Image': config.get('Image'), 'Config': config,
+                                              'State': {'Running': False, 'StartedAt': '0001-01-01T00:00:00Z', 'ExitCode': 0},
+                                              'NetworkSettings': {'IPAddress': ''}}
+            state.add_event(container_id, 'create')
+            return self.send(201, {'Id': container_id, 'Warnings': []})
+        m = re.match(r'^/exec/([^/]+)/(start|json)$', path)
+        if m:
+            exec_instance = state.execs.get(m.group(1))
+            if not exec_instance:
+                return self.send(404, b'No such exec instance', 'text/plain')
+            if m.group(2) == 'json':
+                return self.send(200, {'ExitCode': exec_instance['ExitCode'], 'Running': False})
+            self.read_body()
+            return self.stream_exec(state, exec_instance)
+        if path == '/containers/json':
+            return self.send(200, [{'Id': container['Id'], 'Names': [container['Name']], 'Image': container['Image'],
+                                    'Status': 'Up' if container['State']['Running'] else 'Exited'}
+                                   for container in list(state.containers.values())])
+        m = re.match(r'^/containers/([^/]+)(/.*)?$', path)
+        if m:
+            container = state.find(m.group(1))
+            action = m.group(2)
+            if not container:
+                return self.send(404, ('No such container: %s' % m.group(1)).encode('utf-8'), 'text/plain')
+            if action is None and method == 'DELETE':
+                state.containers.pop(container['Id'], None)
+                state.add_event(container['Id'], 'destroy')
+                return self.send(204)
+            if action == '/json':
+                return self.send(200, container)
+            if action == '/exec' and method == 'POST':
+                exec_id = 'exec%d' % next(state.ids)
+                state.execs[exec_id] = {'Cmd': self.read_body().get('Cmd') or [], 'ExitCode': 0}
+                return self.send(201, {'Id': exec_id})
+            if action == '/start':
+                self.read_body()
+                container['State'] = {'Running': True, 'StartedAt': '2014-01-01T00:00:00Z', 'ExitCode': 0}
+                container['NetworkSettings'] = {'IPAddress': '127.0.0.1'}
+                state.add_event(container['Id'], 'start')
+                return self.send(204)
+            if action in ['/stop', '/kill']:
+                container['State']['Running'] = False
+                state.add_event(container['Id'], 'die')
+                return self.send(204)
+            if action == '/copy':
+                self.read_body()
+                return self.send(404, b'Could not find the file', 'text/plain')
+        return self.send(404, ('Unsupported call: %s %s' % (method, path)).encode('utf-8'), 'text/plain')
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+class FakeDockerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, images, output_lines, socket_path=None):
+        if socket_path:
+            # served on a unix socket like a local docker daemon
+            self.address_family = socket.AF_UNIX
+        HTTPServer.__init__(self, socket_path or ('127.0.0.1', 0), FakeDockerHandler)
+        self.state = FakeDockerState(images, output_lines)
+        if socket_path:
+            self.base_url = 'unix://%s' % socket_path
+        else:
+            self.base_url = 'http://127.0.0.1:%d' % self.server_address[1]
+        # sshd of every container, answers with a protocol banner only
+        self.ssh_socket = socket.socket()
+        self.ssh_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ssh_socket.bind(('127.0.0.1', 0))
+        self.ssh_socket.listen(128)
+        self.ssh_port = self.ssh_socket.getsockname()[1]
+        self._connections = []
+
+    def server_bind(self):
+        if self.address_family == socket.AF_UNIX:
+            # HTTPServer looks up the host name of its address, a socket path has none
+            TCPServer.server_bind(self)
+        else:
+            HTTPServer.server_bind(self)
+
+    def _serve_ssh(self):
+        while True:
+            (connection, address) = self.ssh_socket.accept()
+            try:
+                connection.sendall(b'SSH-2.0-benchmark\r\n')
+            finally:
+                connection.close()
+
+    def start(self):
+        for target in [self.serve_forever, self._serve_ssh]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        # connection threads are kept to close keep-alive connections in stop()
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        with self.state.lock:
+            self._connections = [(t, r) for (t, r) in self._connections if t.is_alive()] + [(thread, request)]
+        thread.start()
+
+    def stop(self):
+        with self.state.lock:
+            self.state.stopped = True
+            self.state.lock.notify_all()
+        self.shutdown()
+        for (thread, request) in self._connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+
+    def handle_error(self, request, client_address):
+        # clients drop keep-alive connections and event streams at any time
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+class Benchmark:
+    """ Runs orchestrator code paths for a number of modules against the fake docker """
+    def __init__(self, work_dir, parallel, output_lines, template_dir, transport, endpoints=3):
+        self.work_dir = work_dir
+        self.parallel = parallel
+        self.transport = transport
+        self.output_lines = output_lines
+        self.template_dir = template_dir
+        self.docker_image = 'spil/slc-puppet-base'
+        self.docker_image_tag = '6.5'
+        self.server = FakeDockerServer({'%s:%s' % (self.docker_image, self.docker_image_tag): 'benchmark'}, output_lines)
+        self.server.start()
+        # docker hosts of the 'endpoints' benchmark, base image is built on each of them
+        self.endpoint_servers = [FakeDockerServer({'spil/slc-puppet:6.5': 'benchmark'}, output_lines,
+                                                  socket_path=os.path.join(work_dir, 'docker_%d.sock' % index))
+                                 for index in range(endpoints)]
+        for server in self.endpoint_servers:
+            server.start()
+        # parallel tests are split unevenly when possible, EndpointBalancer has to respect every capacity
+        self.endpoint_capacities = [max(1, parallel // endpoints + (1 if index < parallel % endpoints else 0))
+                                    for index in range(endpoints)]
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as f:
+            f.write(STUB_SSH)
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['BENCHMARK_OUTPUT_LINES'] = str(output_lines)
+        self.rsa_key = os.path.join(work_dir, 'docker_rsa')
+
+    def reports_dir(self, name, modules):
+        reports_dir = os.path.join(self.work_dir, '%s_%d' % (name, modules))
+        puppet_test.clean_reports_dir(reports_dir)
+        return reports_dir
+
+    def servers(self):
+        return [self.server] + self.endpoint_servers
+
+    def stop(self):
+        for server in self.servers():
+            server.stop()
+
+    def container(self, server=None, **kwargs):
+        server = server or self.server
+        kwargs.setdefault('docker_image', self.docker_image)
+        kwargs.setdefault('docker_image_tag', self.docker_image_tag)
+        return puppet_test.PuppetContainer(puppet_src_dir=self.work_dir,
+                                           docker_base_url=server.base_url,
+                                           ssh_port=server.ssh_port,
+                                           rsa_key=self.rsa_key,
+                                           transport=self.transport,
+                                           **kwargs)
+
+    def schedule(self, modules, test_module, parallel=None):
+        """ Run test_module for every module, returns [seconds every module took] """
+        durations = []
+        def timed(module):
+            start = timeit.default_timer()
+            try:
+                return test_module(module)
+            finally:
+                durations.append(timeit.default_timer() - start)
+        tasks = [(module, functools.partial(timed, module)) for module in modules]
+        results = puppet_test.TestScheduler(parallel or self.parallel).run(tasks)
+        failed = [result['puppet_module'] for result in results if result.get('puppet_failed') is not False]
+        if failed:
+            raise Exception('%d modules failed, first: %s' % (len(failed), failed[0]))
+        return durations
+
+    def run_container(self, modules):
+        reports_dir = self.reports_dir('container', modules)
+        def test_module(module):
+            return puppet_test.test_container(self.container(puppet_facter_module=module,
+                                              log_dir=puppet_test.module_report_dir(reports_dir, module)))
+        return self.schedule(['module_%d' % i for i in range(modules)], test_module)
+
+    def run_pool(self, modules):
+        reports_dir = self.reports_dir('pool', modules)
+        container_pool = puppet_test.ContainerPool(self.parallel, puppet_test.ContainerBudget(modules),
+                                                   lambda container_name: self.container(container_name=container_name),
+                                                   name_prefix='benchmark_pool')
+        container_pool.start()
+        try:
+            return self.schedule(['module_%d' % i for i in range(modules)],
+                                 lambda module: puppet_test.test_pool_module(container_pool, module,
+                                                    puppet_test.module_report_dir(reports_dir, module)))
+        finally:
+            container_pool.close()
+
+    def run_endpoints(self, modules):
+        """ Base image is built on every docker endpoint, modules are placed by EndpointBalancer """
+        reports_dir = self.reports_dir('endpoints', modules)
+        servers = dict([(server.base_url, server) for server in self.endpoint_servers])
+        endpoints = puppet_test.parse_docker_endpoints(['%s=%d' % (server.base_url, capacity) for (server, capacity)
+                                                        in zip(self.endpoint_servers, self.endpoint_capacities)], self.parallel)
+        errors = []
+        def prepare_base_image(index, endpoint):
+            try:
+                pcontainer = self.container(server=servers[endpoint.base_url], docker_image='spil/slc-puppet',
+                                            log_dir=puppet_test.module_report_dir(reports_dir, 'base_%d' % index))
+                pcontainer.remove()
+                result = pcontainer.kick()
+                if int(result['retcode']) not in [0, 2]:
+                    raise Exception('base puppet run failed: %s' % result['stderr'])
+                endpoint.base_image_tag = 'benchmark_%d' % modules
+                pcontainer.docker_client.commit(pcontainer.container_name, repository=self.docker_image, tag=endpoint.base_image_tag)
+                pcontainer.remove()
+                endpoint.base_image_id = puppet_test.docker_image_id(pcontainer.docker_client,
+                                                                     '%s:%s' % (self.docker_image, endpoint.base_image_tag))
+            except Exception as e:
+                errors.append('%s: %s' % (endpoint.base_url, e))
+        preparing = [threading.Thread(target=prepare_base_image, args=(index, endpoint))
+                     for (index, endpoint) in enumerate(endpoints)]
+        for thread in preparing:
+            thread.start()
+        for thread in preparing:
+            thread.join()
+        if errors:
+            raise Exception('Can not prepare base image on %s' % ', '.join(errors))
+
+        running = dict([(endpoint.base_url, 0) for endpoint in endpoints])
+        overbooked = []
+        lock = threading.Lock()
+        def test_module(endpoint, module):
+            with lock:
+                running[endpoint.base_url] += 1
+                if running[endpoint.base_url] > endpoint.capacity:
+                    overbooked.append('%s: %d tests, capacity %d' % (endpoint.base_url, running[endpoint.base_url], endpoint.capacity))
+            try:
+                return puppet_test.test_container(self.container(server=servers[endpoint.base_url],
+                                                  docker_image_tag=endpoint.base_image_tag, puppet_facter_module=module,
+                                                  log_dir=puppet_test.module_report_dir(reports_dir, module)))
+            finally:
+                with lock:
+                    running[endpoint.base_url] -= 1
+        balancer = puppet_test.EndpointBalancer(endpoints)
+        durations = self.schedule(['module_%d' % i for i in range(modules)],
+                                  lambda module: puppet_test.test_on_endpoint(balancer, test_module, module),
+                                  parallel=sum(self.endpoint_capacities))
+        if overbooked:
+            raise Exception('Endpoint capacity exceeded, first: %s' % overbooked[0])
+        return durations
+
+    def run_report(self, modules):
+        reports_dir = self.reports_dir('report', modules)
+        log = b''.join([b'\x1b[0;36mDebug: /Stage[main]/Base/File[/tmp/file_%d]: benchmark output\x1b[0m\n' % i
+                        for i in range(self.output_lines)])
+        results = []
+        for i in range(modules):
+            module = 'module_%d' % i
+            module_report_dir_path = puppet_test.module_report_dir(reports_dir, module)
+            os.makedirs(module_report_dir_path)
+            for stream in ['stdout', 'stderr']:
+                with gzip.open(puppet_test.module_log_path(module_report_dir_path, stream), 'wb') as f:
+                    f.write(log)
+            results.append({'puppet_module': module, 'puppet_failed': False, 'task': None, 'retcode': 2,
+                            'stdout': '', 'stderr': '', 'time': '0:00:01', 'time_seconds': 1.0,
+                            'timings': dict([(phase, 0.1) for phase in puppet_test.CONTAINER_PHASES]),
+                            'output': {}})
+        start = timeit.default_timer()
+        puppet_test.results_save_report(results, reports_dir, do_render_html=True, template_dir=self.template_dir)
+        return [(timeit.default_timer() - start) / modules] * modules
+
+    def calls(self):
+        return sum([server.state.calls for server in self.servers()])
+
+    def run(self, name, modules):
+        calls = self.calls()
+        start = timeit.default_timer()
+        durations = getattr(self, 'run_%s' % name)(modules)
+        # containers are removed in the background, the run is over when they are gone
+        puppet_test.get_container_reaper().wait()
+        elapsed = timeit.default_timer() - start
+        return {'modules': modules,
+                'seconds': round(elapsed, 3),
+                'modules_per_second': round(modules / elapsed, 2),
+                'module_overhead_ms': round(1000 * sum(durations) / len(durations), 2),
+                'docker_calls_per_module': round(float(self.calls() - calls) / modules, 2)}
+
+def check_thresholds(measurements, thresholds):
+    """ [regression messages] of measurements above the stored thresholds """
+    regressions = []
+    for (name, sizes) in sorted(measurements.items()):
+        for (modules, measurement) in sorted(sizes.items()):
+            limits = thresholds.get(name, {}).get(modules, {})
+            for (metric, limit) in sorted(limits.items()):
+                if measurement.get(metric) is not None and measurement[metric] > limit:
+                    regressions.append('%s, %d modules: %s %s > %s' % (name, modules, metric, measurement[metric], limit))
+    return regressions
+
+def thresholds_from(measurements, tolerance):
+    thresholds = {}
+    for (name, sizes) in measurements.items():
+        for (modules, measurement) in sizes.items():
+            thresholds.setdefault(name, {})[modules] = dict([(metric, round(measurement[metric] * (1 + tolerance), 2))
+                for metric in ['module_overhead_ms', 'docker_calls_per_module']])
+    return thresholds
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark puppet_test.py against a fake docker daemon and a stub ssh',
+        epilog="Example: ./docker/benchmark.py --modules 10,100 --benchmark container,report")
+
+    parser.add_argument("--modules", dest="modules", default='10,100,1000',
+            help="comma separated numbers of modules to benchmark with")
+
+    parser.add_argument("--benchmark", dest="benchmarks", default=','.join(BENCHMARKS),
+            help="comma separated benchmarks to run: %s" % ', '.join(BENCHMARKS))
+
+    parser.add_argument("--parallel", "-p", dest="parallel_jobs", default=4, type=int,
+            help="number of modules tested in parallel")
+
+    parser.add_argument("--transport", dest="transport", default='exec', choices=sorted(puppet_test.TRANSPORTS),
+            help="transport of puppet_test.py to benchmark")
+
+    parser.add_argument("--endpoints", dest="endpoints", default=3, type=int,
+            help="number of fake docker daemons on unix sockets for the 'endpoints' benchmark, "
+                 "--parallel is split between them")
+
+    parser.add_argument("--output-lines", dest="output_lines", default=100, type=int,
+            help="lines of puppet output printed by the stub for every module")
+
+    parser.add_argument("--thresholds", dest="thresholds",
+            default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_thresholds.yml'),
+            help="yaml file with maximum accepted values, run fails when one is exceeded")
+
+    parser.add_argument("--update-thresholds", dest="update_thresholds", action='store_true',
+            help="store measured values increased by --tolerance as the new thresholds")
+
+    parser.add_argument("--tolerance", dest="tolerance", default=0.5, type=float,
+            help="allowed regression for --update-thresholds, 0.5 means 50%%")
+
+    parser.add_argument("--output", dest="output",
+            help="save measurements to this json file")
+
+    parser.add_argument("--verbose", "-v", dest="verbose", action='store_true',
+            help="keep logging of puppet_test.py")
+
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix='puppet_test_benchmark_')
+    measurements = {}
+    benchmark = Benchmark(work_dir, args.parallel_jobs, args.output_lines,
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'), args.transport,
+                          args.endpoints)
+    try:
+        for name in args.benchmarks.split(','):
+            for modules in [int(modules) for modules in args.modules.split(',')]:
+                measurement = benchmark.run(name, modules)
+                measurements.setdefault(name, {})[modules] = measurement
+                print('%-10s %5d modules: %8.3fs %8.2f modules/s %8.2f ms/module %6.2f docker calls/module' % (
+                      name, modules, measurement['seconds'], measurement['modules_per_second'],
+                      measurement['module_overhead_ms'], measurement['docker_calls_per_module']))
+    finally:
+        benchmark.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(measurements, f, indent=2, sort_keys=True)
+
+    if args.update_thresholds:
+        thresholds = {}
+        if os.path.exists(args.thresholds):
+            with open(args.thresholds) as f:
+                thresholds = yaml.safe_load(f) or {}
+        for (name, sizes) in thresholds_from(measurements, args.tolerance).items():
+            thresholds.setdefault(name, {}).update(sizes)
+        with open(args.thresholds, 'w') as f:
+            f.write(yaml.safe_dump(thresholds, default_flow_style=False))
+        print('Thresholds saved to %s' % args.thresholds)
+        sys.exit(0)
+
+    thresholds = {}
+    if os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = yaml.safe_load(f) or {}
+    regressions = check_thresholds(measurements, thresholds)
+    for regression in regressions:
+        logging.error('Regression: %s' % regression)
+    sys.exit(1 if regressions else 0)
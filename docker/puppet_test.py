@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import docker
+import requests
 import sys
 import os
 import shlex
@@ -8,18 +9,55 @@ import logging
 import time
 import argparse
 import tempfile
-from multiprocessing import Pool
-from threading import Timer
+import json
+import socket
+import threading
+import collections
+import hashlib
+import contextlib
+import timeit
+import tarfile
+import struct
+import gzip
+import io
+import multiprocessing
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import itertools
+import functools
 import datetime
 import shutil
+import copy
 import yaml
 import fnmatch, re
 import time
 import math
+import sqlite3
 from jinja2 import Environment, FileSystemLoader, meta
+try:
+    from docker.errors import APIError
+except ImportError:
+    # docker-py < 0.6
+    from docker import APIError
+try:
+    import pyinotify
+except ImportError:
+    # --watch polls modification times instead
+    pyinotify = None
 
 logging.basicConfig(format='%(asctime)-15s %(levelname)s:%(message)s', level=logging.INFO)
 
+@contextlib.contextmanager
+def timed_phase(timings, phase):
+    """ Store duration of the with block in timings[phase] """
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        timings[phase] = round(timeit.default_timer() - start, 6)
+
 # Retry decorator with exponential backoff
 def retry(tries, delay=3, backoff=2):
     '''Retries a function or method until it returns True.
@@ -59,6 +97,249 @@ def retry(tries, delay=3, backoff=2):
       return f_retry # true decorator -> decorated function
     return deco_retry  # @retry(arg[, ...]) -> true decorator
 
+class DockerEventWatcher:
+    """ Follow docker event stream in a background thread.
+        Threads waiting for a container state change subscribe to
+        (container id, event status) and are woken up as soon as docker reports it.
+    """
+    def __init__(self, docker_base_url):
+        self.docker_base_url = docker_base_url
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._thread = None
+
+    def _follow(self):
+        try:
+            # endless event stream keeps its own connection out of the shared client
+            client = docker.Client(base_url=self.docker_base_url)
+            for event in client.events():
+                if not isinstance(event, dict):
+                    event = json.loads(event)
+                with self._lock:
+                    waiter = self._waiters.get((event.get('id'), event.get('status')))
+                if waiter:
+                    waiter.set()
+        except Exception as e:
+            logging.debug('Docker event stream closed: %s' % e)
+        with self._lock:
+            self._thread = None
+            # wake up everybody, waiters fall back to inspect polling
+            for waiter in self._waiters.values():
+                waiter.set()
+
+    def subscribe(self, container_id, status):
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters[(container_id, status)] = waiter
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._follow, name='docker-events')
+                self._thread.daemon = True
+                self._thread.start()
+        return waiter
+
+    def unsubscribe(self, container_id, status):
+        with self._lock:
+            self._waiters.pop((container_id, status), None)
+
+_docker_event_watchers = {}
+
+def get_docker_event_watcher(docker_base_url):
+    # watcher thread does not survive fork, so keep one watcher per process
+    key = (os.getpid(), docker_base_url)
+    if key not in _docker_event_watchers:
+        _docker_event_watchers[key] = DockerEventWatcher(docker_base_url)
+    return _docker_event_watchers[key]
+
+# connections kept open to every docker host, enough for all test threads of a host
+DOCKER_CONNECTION_POOL_SIZE = 64
+# seconds a docker host is trusted to be alive after its last successful API call
+DOCKER_HEALTH_TTL = 30
+
+def docker_api_call(method, url):
+    """ Name of docker API call without API version and ids: 'POST /containers/{id}/start' """
+    path = requests.utils.urlparse(url).path
+    path = re.sub(r'^/v[0-9.]+/', '/', path)
+    path = re.sub(r'^/(containers|exec)/(?!json$|create$)[^/]+', r'/\1/{id}', path)
+    path = re.sub(r'^/images/(?!json$|create$|search$|load$).+?(/(json|history|push|tag|get))?$',
+                  lambda match: '/images/{name}%s' % (match.group(1) or ''), path)
+    return '%s %s' % (method.upper(), path)
+
+class DockerApiStats:
+    """ Number of docker API calls, failed calls and their latency by docker host and API call.
+        Latency of streamed responses (exec output, stats) is the time until response headers.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, docker_base_url, call, seconds, failed=False):
+        with self._lock:
+            stats = self._calls.setdefault((docker_base_url, call), {'count':0, 'errors':0, 'seconds':0.0, 'max_seconds':0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if failed:
+                stats['errors'] += 1
+
+    def summary(self):
+        """ List of calls, most time consuming first, for summary.yml """
+        with self._lock:
+            calls = sorted(self._calls.items(), key=lambda item: item[1]['seconds'], reverse=True)
+        return [{'docker_url':docker_base_url, 'call':call, 'count':stats['count'], 'errors':stats['errors'],
+                 'seconds':round(stats['seconds'], 3),
+                 'mean_ms':round(1000 * stats['seconds'] / stats['count'], 1),
+                 'max_ms':round(1000 * stats['max_seconds'], 1)}
+                for ((docker_base_url, call), stats) in calls]
+
+_docker_api_stats = DockerApiStats()
+
+def get_docker_api_stats():
+    return _docker_api_stats
+
+class DockerUnixConnection(requests.packages.urllib3.connection.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        requests.packages.urllib3.connection.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+class DockerUnixConnectionPool(requests.packages.urllib3.connectionpool.HTTPConnectionPool):
+    def __init__(self, socket_path, timeout, maxsize):
+        requests.packages.urllib3.connectionpool.HTTPConnectionPool.__init__(self, 'localhost', maxsize=maxsize)
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def _new_conn(self):
+        return DockerUnixConnection(self.socket_path, self.socket_timeout)
+
+class DockerUnixAdapter(requests.adapters.HTTPAdapter):
+    """ One pool of connections to the docker socket for all requests,
+        docker-py keeps a pool of a single connection per request url instead.
+    """
+    def __init__(self, socket_path, timeout, pool_size):
+        self.pool = DockerUnixConnectionPool(socket_path, timeout, pool_size)
+        requests.adapters.HTTPAdapter.__init__(self)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        # requests >= 2.32 calls this instead of get_connection()
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+
+class DockerClient(docker.Client):
+    """ docker.Client recording every API call in DockerApiStats.
+        Connection errors mark the client failed, see alive().
+    """
+    def __init__(self, docker_base_url, pool_size=DOCKER_CONNECTION_POOL_SIZE):
+        docker.Client.__init__(self, base_url=docker_base_url)
+        self.docker_base_url = docker_base_url
+        if self.base_url.startswith('http://'):
+            # requests keeps only 10 connections by default, threads beyond that reconnect on every call
+            self.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        elif isinstance(self.get_adapter(self.base_url), docker.unixconn.UnixAdapter):
+            self.mount(self.base_url, DockerUnixAdapter(self.get_adapter(self.base_url).socket_path,
+                                                        self.timeout, pool_size))
+        self.failed = False
+        self.last_success = timeit.default_timer()
+
+    def request(self, method, url, *args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            response = docker.Client.request(self, method, url, *args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.failed = True
+            get_docker_api_stats().record(self.docker_base_url, docker_api_call(method, url),
+                                          timeit.default_timer() - start, failed=True)
+            raise
+        finish = timeit.default_timer()
+        get_docker_api_stats().record(self.docker_base_url, docker_api_call(method, url),
+                                      finish - start, failed=response.status_code >= 500)
+        self.failed = False
+        self.last_success = finish
+        return response
+
+    def alive(self, ttl=DOCKER_HEALTH_TTL):
+        """ Ping docker only after a failed call or when the last successful one is older than ttl """
+        if not self.failed and timeit.default_timer() - self.last_success < ttl:
+            return True
+        try:
+            if hasattr(self, 'ping'):
+                self.ping()
+            else:
+                # docker-py < 1.0
+                self.version()
+            return True
+        except (requests.exceptions.RequestException, APIError) as e:
+            logging.warning('Docker "%s" does not respond: %s' % (self.docker_base_url, e))
+            return False
+
+_docker_clients = {}
+_docker_clients_lock = threading.Lock()
+
+def get_docker_client(docker_base_url):
+    """ Client shared by all threads talking to docker_base_url, reconnected when docker does not respond """
+    # connections do not survive fork, so keep one client per process
+    key = (os.getpid(), docker_base_url)
+    with _docker_clients_lock:
+        client = _docker_clients.get(key)
+        if client is None:
+            client = _docker_clients[key] = DockerClient(docker_base_url)
+    if not client.alive():
+        with _docker_clients_lock:
+            if _docker_clients.get(key) is client:
+                logging.info('Reconnect to docker "%s"' % docker_base_url)
+                _docker_clients[key] = DockerClient(docker_base_url)
+            client = _docker_clients[key]
+    return client
+
+def wait_for_container_running(docker_client, container_id, waiter, timeout=30):
+    """ Wait until container is running and has IP address assigned.
+        Wakes up on docker 'start' event, inspect polling with short backoff is a fallback.
+        Returns the last inspect result.
+    """
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        inspect = docker_client.inspect_container(container_id)
+        if inspect['State']['Running'] and inspect['NetworkSettings']['IPAddress']:
+            return inspect
+        if not inspect['State']['Running'] and not inspect['State'].get('StartedAt', '0001').startswith('0001'):
+            # container has been started and already exited, no reason to wait
+            return inspect
+        if time.time() >= deadline:
+            return inspect
+        waiter.wait(min(delay, max(deadline - time.time(), 0)))
+        waiter.clear()
+        delay = min(delay * 2, 1)
+
+def wait_for_ssh_banner(ip, port=22, timeout=30):
+    """ Poll TCP port until sshd answers with its protocol banner. """
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        try:
+            sock = socket.create_connection((ip, port), timeout=1)
+            try:
+                banner = sock.recv(64)
+            finally:
+                sock.close()
+            if banner.startswith(b'SSH-'):
+                return True
+        except (socket.error, socket.timeout):
+            pass
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
 class PuppetContainer:
     def __init__(self, rsa_key,
                  container_name = None,
@@ -72,7 +353,17 @@ class PuppetContainer:
                  ssh_user = 'root',
                  puppet_src_dir = '/vagrant',
                  docker_base_url = 'unix://var/run/docker.sock',
-                 lifetime_limit = 600):
+                 lifetime_limit = 600,
+                 ssh_port = 22,
+                 startup_timeout = 30,
+                 log_dir = None,
+                 profile = False,
+                 transport = 'ssh',
+                 package_cache = None,
+                 fatal_re = None,
+                 mem_limit = None,
+                 cpuset = None,
+                 measure_memory = False):
         if not container_name:
                 self.container_name = "puppet_%s" % puppet_facter_module
         else:
@@ -89,25 +380,45 @@ class PuppetContainer:
         self.docker_base_url = docker_base_url
         self.puppet_src_dir = puppet_src_dir
         self.puppet_dir = puppet_dir
-        self._docker_connection = None
         self.lifetime_limit = lifetime_limit
+        self.ip = None
+        # stream puppet output to stdout.txt.gz/stderr.txt.gz in this directory
+        self.log_dir = log_dir
+        self.profile = profile
+        self.ssh_port = ssh_port
+        self.startup_timeout = startup_timeout
+        # how commands are run inside the container, see TRANSPORTS
+        self.transport = TRANSPORTS[transport]()
+        # PackageCache shared with other containers or None
+        self.package_cache = package_cache
+        # seconds spent in every phase of container life
+        self.timings = {}
+        # puppet apply is aborted as soon as a line of its output matches, None to let it finish
+        self.fatal_re = fatal_re
+        # reason the running puppet apply was aborted for, see abort()
+        self.aborted = None
+        self.cancelled = False
+        # memory limit ('2g') and cpus ('0,1') of the container, None for no limit
+        self.mem_limit = mem_limit
+        self.cpuset = cpuset
+        # record peak memory use of the container in the result
+        self.measure_memory = measure_memory
 
     @property
     def docker_client(self):
-        try:
-            #try to get something from docker, reconnect in case of failure
-            self._docker_connection.info()
-        except:
-            self._docker_connection = docker.Client(base_url=self.docker_base_url)
-        return self._docker_connection
+        return get_docker_client(self.docker_base_url)
 
     def prepare_puppet_command(self):
         command = "ln -sf %(puppet_dir)s/hieradata /etc/puppet/ && cd %(puppet_dir)s && FACTER_module='%(puppet_facter_module)s' FACTER_platform='lxc' FACTER_spil_environment='puppet_test' FACTER_role=%(puppet_facter_role)s puppet apply --hiera_config %(puppet_dir)s/hiera.yaml --detailed-exitcodes --verbose --debug --modulepath '%(puppet_dir)s/modules' manifests/site.pp" % {'puppet_dir':self.puppet_dir,'puppet_facter_role':self.puppet_facter_role,'puppet_facter_module':self.puppet_facter_module}
+        if self.profile:
+            # trace evaluation time of every resource and keep the run report to pull it out of the container
+            command += " --evaltrace --summarize --lastrunreport %s" % PUPPET_REPORT_PATH
+        if self.package_cache:
+            command = "%s && %s" % (self.package_cache.prepare_command(), command)
         return command
 
     def prepare_ssh_command(self, ipaddress, command):
         ssh_command = "ssh -o LogLevel=FATAL -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o IdentitiesOnly=yes -i %(rsa_key)s %(ssh_user)s@%(ipaddress)s '%(command)s'" % {'ipaddress':ipaddress,'command':command,'rsa_key':self.rsa_key,'ssh_user':self.ssh_user}
-        logging.info('SSH command: %s' % command)
         return ssh_command
 
     def remove(self):
@@ -116,7 +427,7 @@ class PuppetContainer:
         """
         try:
             inspect = self.docker_client.inspect_container(self.container_name)
-        except docker.APIError as e:
+        except APIError as e:
             # raise APIError(e, response, explanation=explanation)
             # APIError: 404 Client Error: Not Found ("No such container: puppeta")
             logging.info(e.explanation)
@@ -124,20 +435,54 @@ class PuppetContainer:
 
         if inspect['State']['Running']:
             logging.info('Container "%s" detected in a "running" state... stop and remove' % self.container_name)
-            self.docker_client.stop(self.container_name)
+            with timed_phase(self.timings, 'stop'):
+                self.docker_client.stop(self.container_name)
         else:
             logging.info('Container "%s" detected... remove' % self.container_name)
 
         logging.info('Removing container "%s"' % self.container_name)
-        self.docker_client.remove_container(self.container_name)
+        with timed_phase(self.timings, 'remove'):
+            self.docker_client.remove_container(self.container_name)
         return 0
 
+    @retry(tries=3, delay=1, backoff=2)
+    def destroy(self):
+        """ Kill and remove container in one call, nothing is left to wait for in it.
+            Returns True when the container is gone.
+        """
+        try:
+            with timed_phase(self.timings, 'remove'):
+                self.docker_client.remove_container(self.container_name, force=True)
+        except APIError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return True
+            logging.info('Can not remove container "%s": %s' % (self.container_name, e))
+            return False
+        except Exception as e:
+            logging.info('Can not remove container "%s": %s' % (self.container_name, e))
+            return False
+        return True
+
     def emergency_exit(self):
         logging.info("Emergency exit: %s !!!!" % self.container_name)
         #self.remove()
         self.docker_client.stop(self.container_name)
 
-    @retry(tries=4,delay=1, backoff=2)
+    def abort(self, reason, cancelled=False):
+        """ Kill container right away, the puppet apply running in it fails with reason.
+            cancelled is set when the whole run is cancelled, not because of this module.
+        """
+        if self.aborted:
+            return
+        self.aborted = reason
+        self.cancelled = cancelled
+        logging.info('Abort "%s": %s' % (self.container_name, reason))
+        try:
+            self.docker_client.kill(self.container_name)
+        except Exception as e:
+            logging.error('Can not kill container "%s": %s' % (self.container_name, e))
+
+    @retry(tries=3,delay=0.2, backoff=2)
     def test_ssh(self, ip):
         task = self.prepare_ssh_command(ip, 'ls -la')
 
@@ -148,27 +493,47 @@ class PuppetContainer:
             return False
 
     def kick(self):
+        failure = self.boot()
+        if failure:
+            return failure
+        return self.apply()
+
+    def boot(self):
+        """ Create and start container, wait until it is ready to apply puppet.
+            Returns None on success or a failed result.
+        """
         logging.info('Create container: %s' % self.container_name)
-        if not self.docker_client.images(self.docker_image):
+        self.timings = {}
+        self.ip = None
+        with timed_phase(self.timings, 'image_check'):
+            image_found = self.docker_client.images(self.docker_image)
+        if not image_found:
             stderr = "Docker error: Can not find image %s" % self.docker_image
             logging.error(stderr)
             result = {'puppet_module':self.puppet_facter_module, 'task':None, 'retcode':1, 'stdout':None, 'stderr':stderr, 'time':None}
             return result
 
-        self.docker_client.create_container("%s:%s" % (self.docker_image, self.docker_image_tag),
-                                            command=["/root/puppet/docker/init.sh"],
-                                            stdin_open=True, tty=True,volumes=[self.puppet_dir],
-                                            name=self.container_name)
-
-        time.sleep(1)
+        with timed_phase(self.timings, 'create'):
+            # swap is limited as well, otherwise a module over its limit swaps instead of failing
+            container = self.docker_client.create_container("%s:%s" % (self.docker_image, self.docker_image_tag),
+                                                            command=self.transport.container_command,
+                                                            stdin_open=True, tty=True,volumes=[self.puppet_dir],
+                                                            mem_limit=self.mem_limit or 0, memswap_limit=self.mem_limit or 0,
+                                                            cpuset=self.cpuset,
+                                                            name=self.container_name)
+        get_container_reaper().track(self.docker_base_url, container['Id'])
 
         logging.info('Start')
-        self.docker_client.start(self.container_name,binds={self.puppet_src_dir: self.puppet_dir})
-
-        time.sleep(2)
-
+        waiter = get_docker_event_watcher(self.docker_base_url).subscribe(container['Id'], 'start')
         try:
-            inspect = self.docker_client.inspect_container(self.container_name)
+            with timed_phase(self.timings, 'start'):
+                binds = {self.puppet_src_dir: self.puppet_dir}
+                if self.package_cache:
+                    binds.update(self.package_cache.binds())
+                self.docker_client.start(container['Id'],binds=binds)
+            with timed_phase(self.timings, 'ip_assign'):
+                inspect = wait_for_container_running(self.docker_client, container['Id'], waiter,
+                                                     timeout=self.startup_timeout)
         except APIError as e:
             # raise APIError(e, response, explanation=explanation)
             # APIError: 404 Client Error: Not Found ("No such container: puppeta")
@@ -180,6 +545,8 @@ class PuppetContainer:
                       'task':None, 'retcode':1,
                       'stdout':stdout, 'stderr':stderr, 'time':None}
             return result
+        finally:
+            get_docker_event_watcher(self.docker_base_url).unsubscribe(container['Id'], 'start')
 
         if not inspect['State']['Running']:
             stdout = "Docker error: Can not detect running container %s" %  self.container_name
@@ -205,46 +572,113 @@ class PuppetContainer:
                       'stdout':stdout, 'stderr':stderr, 'time':None}
             return result
 
-        logging.info("Address: %s" % inspect['NetworkSettings']['IPAddress'])
-        time.sleep(3)
-
-	ip = inspect['NetworkSettings']['IPAddress']
+        ip = inspect['NetworkSettings']['IPAddress']
+        logging.info("Address: %s" % ip)
 
-        if not self.test_ssh(ip):
-            logging.error('Can not establish ssh connection: %s' % ip)
+        if not self.transport.wait_ready(self, ip):
+            stdout = 'Can not establish %s connection: %s' % (self.transport.name, ip)
+            logging.error(stdout)
             result = {'puppet_module':self.puppet_facter_module,
                       'task':None, 'retcode':1,
-                      'stdout':stdout, 'stderr':stderr, 'time':None}
+                      'stdout':stdout, 'stderr':self.docker_client.logs(self.container_name), 'time':None}
             return result
+        logging.info('Container "%s" ready: %s' % (self.container_name, self.timings))
+        self.ip = ip
+        return None
 
-
-        task = self.prepare_ssh_command(ip, self.prepare_puppet_command())
+    def apply(self):
+        """ Apply puppet inside a container started by boot() """
+        command = self.prepare_puppet_command()
+        task = self.transport.describe(self, command)
 
         stdout = ''
         stderr = ''
+        output = None
         time_start = 0
         time_finish = 0
 
+        self.aborted = None
+        self.cancelled = False
+        if get_lifetime_watchdog().cancelled:
+            return cancelled_result(self.puppet_facter_module, get_lifetime_watchdog().cancelled)
+
+        if self.package_cache:
+            cached_packages = self.package_cache.packages()
         time_start = datetime.datetime.now().replace(microsecond=0)
-        t = Timer(self.lifetime_limit, self.emergency_exit)
-        t.start()
-        if self.interactive:
-            retcode = run_and_show(task,ignore_error=True)
-        if not self.interactive:
-            (retcode, stdout, stderr) = run_and_capture_output(task,ignore_error=True)
-        t.cancel()
+        watchdog_token = get_lifetime_watchdog().watch(self, self.lifetime_limit)
+        try:
+            with timed_phase(self.timings, 'puppet_apply'):
+                if self.interactive:
+                    retcode = self.transport.run_and_show(self, command)
+                elif self.log_dir:
+                    (retcode, stdout, stderr, output) = self.transport.run_and_stream_output(self, command,
+                                                            module_log_path(self.log_dir, 'stdout'),
+                                                            module_log_path(self.log_dir, 'stderr'))
+                else:
+                    (retcode, stdout, stderr) = self.transport.run_and_capture_output(self, command)
+        finally:
+            # a deadline left behind would stop the next container of the same name
+            get_lifetime_watchdog().unwatch(watchdog_token)
         time_finish = datetime.datetime.now().replace(microsecond=0)
 
         time_delta = time_finish - time_start
 
+        if retcode is None or (self.aborted and not is_puppet_failed(retcode)):
+            # aborted module counts as failed for --max-failures and the history
+            retcode = KILLED_RETCODE
 
         result = {'puppet_module':self.puppet_facter_module,
                   'puppet_failed': is_puppet_failed(retcode),
                   'task':task, 'retcode':retcode,
-                  'stdout':stdout, 'stderr':stderr, 'time':str(time_delta)}
+                  'stdout':stdout, 'stderr':stderr, 'time':str(time_delta),
+                  'time_seconds':self.timings['puppet_apply'],
+                  'timings':dict(self.timings)}
+        if output:
+            result['output'] = output
+        if self.aborted:
+            result['puppet_failed'] = True
+            result['aborted'] = self.aborted
+            if self.cancelled:
+                result['cancelled'] = True
+        if self.package_cache:
+            # packages downloaded by modules running at the same time are counted for each of them
+            result['packages'] = {'downloaded': len(set(self.package_cache.packages()) - set(cached_packages))}
+            if output:
+                result['packages']['installed'] = output['stdout']['packages']
+        if self.measure_memory:
+            try:
+                with timed_phase(self.timings, 'memory_stats'):
+                    result['memory_bytes'] = docker_container_max_memory(self.docker_client, self.container_name)
+            except Exception as e:
+                logging.info('Can not get memory use of "%s": %s' % (self.container_name, e))
+        if self.profile:
+            result['profile'] = self.collect_profile()
 
         return result
 
+    def collect_profile(self):
+        """ Per resource and per class evaluation times from the run report,
+            evaltrace lines of the log are used when report can not be pulled out of the container.
+        """
+        try:
+            with timed_phase(self.timings, 'report_copy'):
+                report = docker_copy_file(self.docker_client, self.container_name, PUPPET_REPORT_PATH)
+        except Exception as e:
+            logging.info('Can not copy puppet report out of "%s": %s' % (self.container_name, e))
+            report = None
+        if report:
+            if self.log_dir:
+                with open(os.path.join(self.log_dir, 'last_run_report.yaml'), 'wb') as f:
+                    f.write(report)
+            try:
+                return puppet_profile(puppet_report_evaluation_times(report), source='report')
+            except Exception as e:
+                logging.info('Can not parse puppet report of "%s": %s' % (self.container_name, e))
+        if self.log_dir and os.path.exists(module_log_path(self.log_dir, 'stdout')):
+            with gzip.open(module_log_path(self.log_dir, 'stdout')) as f:
+                return puppet_profile(puppet_evaltrace_evaluation_times(f), source='evaltrace')
+        return None
+
 
 def run_and_show(cmd, ignore_error=False):
     cmd_list = shlex.split(str(cmd))
@@ -252,13 +686,13 @@ def run_and_show(cmd, ignore_error=False):
     (stdout, stderr) = process.communicate()
     retcode = process.returncode
     if retcode and not ignore_error:
-        raise SubprocessException("'%s' failed(%d)" % (cmd, retcode), retcode)
+        raise subprocess.CalledProcessError(retcode, cmd)
     if retcode and ignore_error:
         logging.debug('Non zero exit code, but ignore: %s' % retcode)
     return retcode
 
 
-def run_and_capture_output(cmd, ignore_error=False):
+def run_and_capture_output(cmd, ignore_error=False, env=None):
     """
     Function to call a subprocess and gather the output.
     """
@@ -272,7 +706,7 @@ def run_and_capture_output(cmd, ignore_error=False):
     stdouttmp = tempfile.TemporaryFile()
     stderrtmp = tempfile.TemporaryFile()
 
-    process = subprocess.Popen(cmd_list, stdout=stdouttmp, stderr=stderrtmp)
+    process = subprocess.Popen(cmd_list, stdout=stdouttmp, stderr=stderrtmp, env=env)
     process.communicate()
     retcode = process.poll()
 
@@ -285,18 +719,842 @@ def run_and_capture_output(cmd, ignore_error=False):
     stderrtmp.close()
 
     if retcode and not ignore_error:
-        raise SubprocessException("'%s' failed(%d): %s" % (cmd_list, retcode, stderr), retcode)
+        raise subprocess.CalledProcessError(retcode, cmd_list, output=stderr)
     if retcode and ignore_error:
         logging.debug('Non zero exit code, but ignore: %s' % retcode)
     return (retcode, stdout, stderr)
 
 
+ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*m')
+PUPPET_PACKAGE_INSTALLED_RE = re.compile(r'/Package\[[^\]]*\]/ensure: created')
+# errors puppet apply can not recover from: catalog is not compiled or can not be applied at all
+PUPPET_FATAL_RE = re.compile(r'^Error: (?:Could not retrieve catalog|Could not find (?:class|resource|dependency)|'
+                             r'Could not parse|Could not run|Evaluation Error|Duplicate (?:declaration|definition)|'
+                             r'Invalid relationship|Failed to apply catalog|Found \d+ dependency cycles?)')
+
+# bytes of an output line kept in the tail, the log file keeps whole lines
+TAIL_LINE_BYTES = 4096
+
+def to_text(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+def _stream_pipe(pipe, log_file_path, tail, summary, fatal_re=None, on_fatal=None):
+    digest = hashlib.sha1()
+    with gzip.open(log_file_path, 'wb') as log_file:
+        for line in iter(pipe.readline, b''):
+            log_file.write(line)
+            digest.update(line)
+            tail.append(line if len(line) <= TAIL_LINE_BYTES else line[:TAIL_LINE_BYTES] + b' [...]\n')
+            summary['lines'] += 1
+            summary['bytes'] += len(line)
+            message = ANSI_ESCAPE_RE.sub('', to_text(line)).lstrip()
+            if message.startswith('Error:'):
+                summary['errors'] += 1
+                if fatal_re and fatal_re.search(message):
+                    on_fatal(message.rstrip())
+            elif message.startswith('Warning:'):
+                summary['warnings'] += 1
+            if PUPPET_PACKAGE_INSTALLED_RE.search(message):
+                summary['packages'] += 1
+    summary['sha1'] = digest.hexdigest()
+    pipe.close()
+
+def _stream_output(stdout_pipe, stderr_pipe, stdout_log_file_path, stderr_log_file_path, tail_lines,
+                   fatal_re=None, on_fatal=None):
+    """ Stream both pipes to the log files until they are closed.
+        on_fatal is called once with the first line matching fatal_re, pipes are still read to the end.
+        Returns (stdout tail, stderr tail, summary).
+    """
+    log_dir = os.path.dirname(os.path.abspath(stdout_log_file_path))
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    fatal = []
+    fatal_lock = threading.Lock()
+    def on_first_fatal(message):
+        with fatal_lock:
+            if fatal:
+                return
+            fatal.append(message)
+        logging.info('Fatal error in puppet output: %s' % message)
+        if on_fatal:
+            on_fatal(message)
+
+    streams = {}
+    readers = []
+    for (name, pipe, log_file_path) in [('stdout', stdout_pipe, stdout_log_file_path),
+                                        ('stderr', stderr_pipe, stderr_log_file_path)]:
+        streams[name] = (collections.deque(maxlen=tail_lines),
+                         {'lines':0, 'bytes':0, 'errors':0, 'warnings':0, 'packages':0, 'log':os.path.abspath(log_file_path)})
+        reader = threading.Thread(target=_stream_pipe, args=(pipe, log_file_path) + streams[name] + (fatal_re, on_first_fatal))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+    for reader in readers:
+        reader.join()
+
+    (stdout_tail, stdout_summary) = streams['stdout']
+    (stderr_tail, stderr_summary) = streams['stderr']
+    summary = {'stdout':stdout_summary, 'stderr':stderr_summary,
+               'truncated': stdout_summary['lines'] > tail_lines or stderr_summary['lines'] > tail_lines}
+    if fatal:
+        summary['fatal'] = fatal[0]
+    return (to_text(b''.join(stdout_tail)), to_text(b''.join(stderr_tail)), summary)
+
+def run_and_stream_output(cmd, stdout_log_file_path, stderr_log_file_path, ignore_error=False, tail_lines=100,
+                          fatal_re=None, on_fatal=None):
+    """
+    Call a subprocess and stream its output to gzip compressed log files as it is produced.
+    Only the last tail_lines lines of every stream and a short summary are kept in memory.
+    Subprocess is killed as soon as an output line matches fatal_re, on_fatal is called with the line.
+    Returns (retcode, stdout tail, stderr tail, summary).
+    """
+    cmd_list = shlex.split(str(cmd))
+    process = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def abort(message):
+        try:
+            process.kill()
+        except OSError:
+            pass
+        if on_fatal:
+            on_fatal(message)
+    (stdout, stderr, summary) = _stream_output(process.stdout, process.stderr,
+                                               stdout_log_file_path, stderr_log_file_path, tail_lines,
+                                               fatal_re=fatal_re, on_fatal=abort)
+    retcode = process.wait()
+
+    if retcode and not ignore_error:
+        raise subprocess.CalledProcessError(retcode, cmd_list, output=stderr)
+    if retcode and ignore_error:
+        logging.debug('Non zero exit code, but ignore: %s' % retcode)
+    return (retcode, stdout, stderr, summary)
+
+def _read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def docker_exec_output(docker_client, exec_id):
+    """ Start exec instance and yield (stream, data) frames of its output as they arrive,
+        stream is 1 for stdout and 2 for stderr.
+    """
+    # exec_start of docker-py drops the stream of every frame, read the multiplexed response directly
+    response = docker_client._post_json(docker_client._url('/exec/%s/start' % exec_id),
+                                        data={'Detach': False, 'Tty': False}, stream=True, timeout=None)
+    docker_client._raise_for_status(response)
+    while True:
+        header = _read_exactly(response.raw, 8)
+        if len(header) < 8:
+            break
+        (stream, length) = struct.unpack('>BxxxL', header)
+        yield (stream, _read_exactly(response.raw, length))
+
+def docker_exec_create(docker_client, container, command):
+    if not hasattr(docker_client, 'exec_create'):
+        raise Exception('Docker exec transport needs docker-py 1.0 or newer, use "--transport ssh"')
+    return docker_client.exec_create(container, ['/bin/bash', '-c', command])['Id']
+
+# exit code of a process killed by SIGKILL, reported when puppet was killed without an exit code
+KILLED_RETCODE = 137
+
+def docker_exec_retcode(docker_client, exec_id, timeout=10):
+    """ Exit code of the exec, output stream may close before docker marks the exec finished """
+    deadline = timeit.default_timer() + timeout
+    inspect = docker_client.exec_inspect(exec_id)
+    while inspect.get('Running') and timeit.default_timer() < deadline:
+        time.sleep(0.1)
+        inspect = docker_client.exec_inspect(exec_id)
+    if inspect.get('Running') or inspect.get('ExitCode') is None:
+        # container was killed (watchdog, fail-fast) under the exec
+        return KILLED_RETCODE
+    return inspect['ExitCode']
+
+def _pump_exec_output(frames, stdout_fd, stderr_fd):
+    try:
+        for (stream, data) in frames:
+            os.write(stderr_fd if stream == 2 else stdout_fd, data)
+    except Exception as e:
+        logging.error('Docker exec output stream failed: %s' % e)
+    finally:
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+
+class SSHTransport:
+    """ Run commands over ssh, sshd is started in the container by docker/init.sh """
+    name = 'ssh'
+    container_command = ["/root/puppet/docker/init.sh"]
+
+    def wait_ready(self, pcontainer, ip):
+        with timed_phase(pcontainer.timings, 'ssh_ready'):
+            return wait_for_ssh_banner(ip, pcontainer.ssh_port, timeout=pcontainer.startup_timeout) and pcontainer.test_ssh(ip)
+
+    def describe(self, pcontainer, command):
+        return pcontainer.prepare_ssh_command(pcontainer.ip, command)
+
+    def run_and_show(self, pcontainer, command):
+        logging.info('SSH command: %s' % command)
+        return run_and_show(self.describe(pcontainer, command), ignore_error=True)
+
+    def run_and_capture_output(self, pcontainer, command):
+        logging.info('SSH command: %s' % command)
+        return run_and_capture_output(self.describe(pcontainer, command), ignore_error=True)
+
+    def run_and_stream_output(self, pcontainer, command, stdout_log_file_path, stderr_log_file_path):
+        logging.info('SSH command: %s' % command)
+        # killing ssh leaves puppet running, the container is killed as well
+        return run_and_stream_output(self.describe(pcontainer, command),
+                                     stdout_log_file_path, stderr_log_file_path, ignore_error=True,
+                                     fatal_re=pcontainer.fatal_re, on_fatal=pcontainer.abort)
+
+class DockerExecTransport:
+    """ Run commands through docker exec API, the container does not need sshd """
+    name = 'exec'
+    # bash keeps the container running, stdin is left open by create_container
+    container_command = ["/bin/bash"]
+
+    def wait_ready(self, pcontainer, ip):
+        # running container is ready to exec
+        return True
+
+    def describe(self, pcontainer, command):
+        return "docker exec %s /bin/bash -c '%s'" % (pcontainer.container_name, command)
+
+    def run_and_show(self, pcontainer, command):
+        logging.info('Exec command: %s' % command)
+        exec_id = docker_exec_create(pcontainer.docker_client, pcontainer.container_name, command)
+        for (stream, data) in docker_exec_output(pcontainer.docker_client, exec_id):
+            output = sys.stderr if stream == 2 else sys.stdout
+            output.write(to_text(data))
+            output.flush()
+        return docker_exec_retcode(pcontainer.docker_client, exec_id)
+
+    def run_and_capture_output(self, pcontainer, command):
+        logging.info('Exec command: %s' % command)
+        exec_id = docker_exec_create(pcontainer.docker_client, pcontainer.container_name, command)
+        output = {1: [], 2: []}
+        for (stream, data) in docker_exec_output(pcontainer.docker_client, exec_id):
+            output[2 if stream == 2 else 1].append(data)
+        return (docker_exec_retcode(pcontainer.docker_client, exec_id), b''.join(output[1]), b''.join(output[2]))
+
+    def run_and_stream_output(self, pcontainer, command, stdout_log_file_path, stderr_log_file_path, tail_lines=100):
+        logging.info('Exec command: %s' % command)
+        exec_id = docker_exec_create(pcontainer.docker_client, pcontainer.container_name, command)
+        # frames are split to a pipe per stream, so both are logged the same way as ssh output
+        (stdout_read_fd, stdout_write_fd) = os.pipe()
+        (stderr_read_fd, stderr_write_fd) = os.pipe()
+        pump = threading.Thread(target=_pump_exec_output,
+                                args=(docker_exec_output(pcontainer.docker_client, exec_id), stdout_write_fd, stderr_write_fd))
+        pump.daemon = True
+        pump.start()
+        # killed container ends the exec output stream
+        (stdout, stderr, summary) = _stream_output(os.fdopen(stdout_read_fd, 'rb'), os.fdopen(stderr_read_fd, 'rb'),
+                                                   stdout_log_file_path, stderr_log_file_path, tail_lines,
+                                                   fatal_re=pcontainer.fatal_re, on_fatal=pcontainer.abort)
+        pump.join()
+        return (docker_exec_retcode(pcontainer.docker_client, exec_id), stdout, stderr, summary)
+
+TRANSPORTS = {'ssh': SSHTransport, 'exec': DockerExecTransport}
+
+
+PUPPET_REPORT_PATH = '/tmp/puppet_test_last_run_report.yaml'
+PUPPET_EVALTRACE_RE = re.compile(r'(/Stage\[[^\]]*\].*?): Evaluated in ([0-9.]+) seconds')
+PUPPET_PATH_ELEMENT_RE = re.compile(r'[^/\[]+(?:\[[^\]]*\])?')
+
+def docker_container_max_memory(docker_client, container):
+    """ Peak memory use of the running container in bytes, None if docker does not report it """
+    # stats of docker-py keep the stream open, read the first sample and close it
+    response = docker_client._get(docker_client._url('/containers/%s/stats' % container), stream=True)
+    try:
+        docker_client._raise_for_status(response)
+        for line in response.iter_lines():
+            if line:
+                return json.loads(to_text(line)).get('memory_stats', {}).get('max_usage')
+    finally:
+        response.close()
+    return None
+
+def docker_copy_file(docker_client, container, path):
+    """ Content of a single file copied out of the container """
+    stream = docker_client.copy(container, path)
+    with tarfile.open(fileobj=stream, mode='r|') as archive:
+        for member in archive:
+            if member.isfile():
+                return archive.extractfile(member).read()
+    return None
+
+class PuppetReportLoader(yaml.SafeLoader):
+    """ Load puppet YAML report, ruby object tags are loaded as plain data """
+
+def _construct_ruby_tag(loader, tag_suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+    return loader.construct_scalar(node)
+
+PuppetReportLoader.add_multi_constructor('!ruby/', _construct_ruby_tag)
+
+def puppet_report_evaluation_times(report):
+    """ [(containment path, evaluation seconds)] of every resource in a puppet YAML report """
+    data = yaml.load(report, Loader=PuppetReportLoader)
+    times = []
+    for (resource, status) in (data.get('resource_statuses') or {}).items():
+        if not status or status.get('evaluation_time') is None:
+            continue
+        path = status.get('containment_path') or [resource]
+        times.append((list(path), float(status['evaluation_time'])))
+    return times
+
+def puppet_evaltrace_evaluation_times(lines):
+    """ [(containment path, evaluation seconds)] from 'Evaluated in' lines of puppet --evaltrace output """
+    times = []
+    for line in lines:
+        m = PUPPET_EVALTRACE_RE.search(ANSI_ESCAPE_RE.sub('', to_text(line)))
+        if m:
+            times.append((PUPPET_PATH_ELEMENT_RE.findall(m.group(1)), float(m.group(2))))
+    return times
+
+def puppet_profile(evaluation_times, source, top=10):
+    """ Slowest resources and classes, class time includes all resources it contains """
+    resources = []
+    classes = {}
+    for (path, seconds) in evaluation_times:
+        resources.append((path[-1], seconds))
+        for element in path[:-1]:
+            if '[' not in element:
+                classes[element] = classes.get(element, 0) + seconds
+    resources.sort(key=lambda item: item[1], reverse=True)
+    return {'source': source,
+            'total': round(sum([seconds for (resource, seconds) in resources]), 6),
+            'resources': [{'name': name, 'seconds': round(seconds, 6)} for (name, seconds) in resources[:top]],
+            'classes': [{'name': name, 'seconds': round(seconds, 6)}
+                        for (name, seconds) in sorted(classes.items(), key=lambda item: item[1], reverse=True)[:top]]}
+
 def test_container(pcontainer):
     pcontainer.remove()
     result = pcontainer.kick()
-    pcontainer.remove()
+    result.setdefault('timings', {}).update(pcontainer.timings)
+    # worker takes the next module while the container is removed
+    get_container_reaper().reap(pcontainer)
     return result
 
+def test_pooled_container(pcontainer):
+    # container is already started by ContainerPool, removal is done by the pool
+    try:
+        return pcontainer.apply()
+    except Exception as e:
+        logging.error('Module "%s" failed in container "%s": %s' % (pcontainer.puppet_facter_module, pcontainer.container_name, e))
+        return {'puppet_module':pcontainer.puppet_facter_module,
+                'task':None, 'retcode':1,
+                'stdout':'', 'stderr':str(e), 'time':None}
+
+class ContainerBudget:
+    """ Number of containers pools may still boot, shared by pools of all docker endpoints """
+    def __init__(self, total):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class ContainerPool:
+    """ Keep containers started from the base image and ready to apply puppet.
+        Every acquired container is used for a single module only, a replacement
+        is booted in background right away so the next module does not wait for it.
+    """
+    def __init__(self, size, budget, container_factory, name_prefix='puppet_pool'):
+        self.size = size
+        self.budget = budget
+        self.container_factory = container_factory
+        self.name_prefix = name_prefix
+        self._ready = Queue.Queue()
+        self._lock = threading.Lock()
+        self._spawned = 0
+        self._booting = 0
+        # acquirers blocked until a booting container is ready
+        self._waiting = 0
+        self._workers = []
+
+    def start(self):
+        for i in range(self.size):
+            self._spawn()
+
+    def _next_container_name(self):
+        with self._lock:
+            container_name = '%s_%d' % (self.name_prefix, self._spawned)
+            self._spawned += 1
+        return container_name
+
+    def _spawn(self):
+        if not self.budget.take():
+            return
+        with self._lock:
+            self._booting += 1
+        self._background(self._warm_up, self._next_container_name())
+
+    def _background(self, target, *args):
+        worker = threading.Thread(target=target, args=args)
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+
+    def _boot(self, container_name):
+        pcontainer = self.container_factory(container_name)
+        try:
+            pcontainer.remove()
+            failure = pcontainer.boot()
+        except Exception as e:
+            logging.error('Can not boot pool container "%s": %s' % (container_name, e))
+            failure = {'puppet_module':None, 'task':None, 'retcode':1,
+                       'stdout':'Docker error: Can not boot container %s' % container_name,
+                       'stderr':str(e), 'time':None}
+        return (pcontainer, failure)
+
+    def _warm_up(self, container_name):
+        item = self._boot(container_name)
+        with self._lock:
+            self._booting -= 1
+            self._ready.put(item)
+
+    def acquire(self):
+        """ Wait for a ready container, returns (pcontainer, boot failure or None) """
+        with self._lock:
+            # every waiting acquirer takes one of the booting or ready containers
+            boot_now = self._waiting >= self._booting + self._ready.qsize()
+            if not boot_now:
+                self._waiting += 1
+        if boot_now:
+            # budget was used up by other pools, boot a container right here
+            item = self._boot(self._next_container_name())
+        else:
+            item = self._ready.get()
+            with self._lock:
+                self._waiting -= 1
+        self._spawn()
+        return item
+
+    def release(self, pcontainer):
+        get_container_reaper().reap(pcontainer)
+
+    def close(self):
+        """ Remove containers nobody acquired and wait for background work """
+        for worker in list(self._workers):
+            worker.join()
+        while not self._ready.empty():
+            (pcontainer, failure) = self._ready.get()
+            get_container_reaper().reap(pcontainer)
+
+def test_pool_module(container_pool, module, log_dir):
+    (pcontainer, failure) = container_pool.acquire()
+    pcontainer.puppet_facter_module = module
+    pcontainer.log_dir = log_dir
+    try:
+        if failure:
+            failure['puppet_module'] = module
+            return failure
+        return test_pooled_container(pcontainer)
+    finally:
+        container_pool.release(pcontainer)
+
+class DockerEndpoint:
+    """ Docker daemon running module tests, capacity is the number of tests it runs at once
+        or 'auto' until it is sized by auto_capacity()
+    """
+    def __init__(self, base_url, capacity):
+        self.base_url = base_url
+        self.capacity = capacity
+        self.running = 0
+        self.base_image_tag = None
+        self.base_image_id = None
+        self.container_pool = None
+        # CPUs and bytes of memory available on the docker host, see inspect_resources()
+        self.cpus = None
+        self.memory = None
+        self._next_cpu = 0
+        self._lock = threading.Lock()
+
+    def is_local(self):
+        return self.base_url.startswith('unix://')
+
+    def inspect_resources(self, docker_client):
+        info = docker_client.info()
+        self.cpus = info.get('NCPU') or (multiprocessing.cpu_count() if self.is_local() else None)
+        # memory in use is known only on this host, total memory is all we know about remote ones
+        self.memory = host_memory_available() if self.is_local() else None
+        if self.memory is None:
+            self.memory = info.get('MemTotal')
+
+    def next_cpuset(self, cpus):
+        """ cpuset of a new container with cpus CPUs, containers are spread over all CPUs of the host """
+        with self._lock:
+            first = self._next_cpu
+            self._next_cpu = (first + cpus) % self.cpus
+        return ','.join([str((first + cpu) % self.cpus) for cpu in range(min(cpus, self.cpus))])
+
+def parse_docker_endpoints(docker_urls, default_capacity):
+    """ Parse URL[=CAPACITY] docker endpoint definitions, CAPACITY is a number or 'auto' """
+    endpoints = []
+    for docker_url in docker_urls:
+        (base_url, separator, capacity) = docker_url.partition('=')
+        capacity = parse_parallel_jobs(capacity) if separator else default_capacity
+        if capacity != 'auto' and capacity < 1:
+            raise ValueError('Docker endpoint capacity must be 1 or greater: %s' % docker_url)
+        endpoints.append(DockerEndpoint(base_url, capacity))
+    return endpoints
+
+def parse_parallel_jobs(value):
+    if value == 'auto':
+        return value
+    return int(value)
+
+# memory a module test is expected to use before it was measured
+DEFAULT_MODULE_MEMORY = 512 * 1024 * 1024
+
+def host_memory_available(meminfo_path='/proc/meminfo'):
+    """ Bytes of memory available for new processes on this host, None when it is not known """
+    meminfo = {}
+    try:
+        with open(meminfo_path) as f:
+            for line in f:
+                (name, separator, value) = line.partition(':')
+                if value.split():
+                    meminfo[name] = int(value.split()[0]) * 1024
+    except (IOError, ValueError):
+        return None
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    # kernels before 3.14 do not estimate available memory
+    if 'MemFree' in meminfo:
+        return meminfo['MemFree'] + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+    return None
+
+def typical_footprint(footprints, default=DEFAULT_MODULE_MEMORY):
+    """ 90th percentile of peak memory use of modules, a few heavy modules do not size tests of all others """
+    if not footprints:
+        return default
+    values = sorted(footprints.values())
+    return values[int(math.ceil(0.9 * len(values))) - 1]
+
+def auto_capacity(cpus, memory, footprint):
+    """ Number of module tests a docker host runs at once: one per CPU as long as their memory fits """
+    capacity = cpus or 1
+    if memory and footprint:
+        capacity = min(capacity, int(memory // footprint))
+    return max(1, capacity)
+
+class MemoryAdmission:
+    """ Hold module tests back while the local docker host is short of memory.
+        A test starts when the memory its module used in past runs is available or nothing else runs there.
+        Free memory of remote docker hosts is not known, tests on them start right away.
+    """
+    def __init__(self, footprints, default_footprint, interval=1.0, ramp_up=30):
+        self.footprints = footprints
+        self.default_footprint = default_footprint
+        self.interval = interval
+        # seconds a started test takes to allocate its memory
+        self.ramp_up = ramp_up
+        self.held = 0
+        self._admitted = {}
+        self._tokens = itertools.count()
+        self._condition = threading.Condition()
+
+    def admit(self, endpoint, module):
+        """ Wait until module test may start on endpoint, returns token for release() """
+        needed = self.footprints.get(module, self.default_footprint)
+        held = False
+        with self._condition:
+            while endpoint.is_local():
+                running = [(started, memory) for (base_url, started, memory) in self._admitted.values() if base_url == endpoint.base_url]
+                available = host_memory_available()
+                if not running or available is None:
+                    break
+                now = time.time()
+                # tests started lately did not allocate their memory yet
+                available -= sum([memory for (started, memory) in running if now - started < self.ramp_up])
+                if available >= needed:
+                    break
+                if not held:
+                    logging.info('Hold module "%s" back: %dMB of memory available, it used %dMB' % (module, available // 2**20, needed // 2**20))
+                    self.held += 1
+                    held = True
+                self._condition.wait(self.interval)
+            token = next(self._tokens)
+            self._admitted[token] = (endpoint.base_url, time.time(), needed)
+        return token
+
+    def release(self, token):
+        with self._condition:
+            self._admitted.pop(token, None)
+            self._condition.notify_all()
+
+class EndpointBalancer:
+    """ Place every module test on the docker endpoint with the lowest load relative to its capacity """
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                free = [endpoint for endpoint in self.endpoints if endpoint.running < endpoint.capacity]
+                if free:
+                    endpoint = min(free, key=lambda endpoint: (float(endpoint.running) / endpoint.capacity, -endpoint.capacity))
+                    endpoint.running += 1
+                    return endpoint
+                self._condition.wait()
+
+    def release(self, endpoint):
+        with self._condition:
+            endpoint.running -= 1
+            self._condition.notify()
+
+def test_on_endpoint(balancer, test_module, module, admission=None):
+    endpoint = balancer.acquire()
+    try:
+        token = admission.admit(endpoint, module) if admission else None
+        try:
+            result = test_module(endpoint, module)
+        finally:
+            if admission:
+                admission.release(token)
+        result['docker_host'] = endpoint.base_url
+        return result
+    finally:
+        balancer.release(endpoint)
+
+class LifetimeWatchdog:
+    """ Single thread enforcing lifetime_limit of all running puppet applies.
+        Containers running past their deadline are stopped with emergency_exit().
+        cancel() aborts all running applies and the ones started later.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._deadlines = {}
+        self._tokens = itertools.count()
+        self._thread = None
+        # reason the run was cancelled for
+        self.cancelled = None
+
+    def watch(self, pcontainer, lifetime_limit):
+        with self._condition:
+            token = next(self._tokens)
+            self._deadlines[token] = (time.time() + lifetime_limit, pcontainer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='lifetime-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+            cancelled = self.cancelled
+        if cancelled:
+            # run was cancelled right after the apply checked it
+            pcontainer.abort(cancelled, cancelled=True)
+        return token
+
+    def cancel(self, reason):
+        with self._condition:
+            self.cancelled = reason
+            running = [pcontainer for (deadline, pcontainer) in self._deadlines.values()]
+        for pcontainer in running:
+            pcontainer.abort(reason, cancelled=True)
+
+    def unwatch(self, token):
+        with self._condition:
+            self._deadlines.pop(token, None)
+            if not self._deadlines:
+                # let the thread exit instead of sleeping until the removed deadline
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.time()
+                expired = [token for (token, (deadline, pcontainer)) in self._deadlines.items() if deadline <= now]
+                expired = [self._deadlines.pop(token)[1] for token in expired]
+                if not expired:
+                    if not self._deadlines:
+                        # nothing to watch, next watch() starts a new thread
+                        self._thread = None
+                        return
+                    self._condition.wait(min(deadline for (deadline, pcontainer) in self._deadlines.values()) - now)
+                    continue
+            for pcontainer in expired:
+                try:
+                    pcontainer.emergency_exit()
+                except Exception as e:
+                    logging.error('Emergency exit of "%s" failed: %s' % (pcontainer.container_name, e))
+
+_lifetime_watchdog = LifetimeWatchdog()
+
+def get_lifetime_watchdog():
+    return _lifetime_watchdog
+
+class ContainerReaper:
+    """ Remove containers of finished tests on background threads.
+        Container removal is retried, close() sweeps containers of this run left behind.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.removed = 0
+        self.failed = []
+        # seconds spent removing containers, they are removed after their results are reported
+        self.seconds = 0.0
+        # ids of containers created by this run by docker host, other runs may share the host
+        self.created = collections.defaultdict(set)
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def track(self, docker_base_url, container_id):
+        with self._lock:
+            self.created[docker_base_url].add(container_id)
+
+    def reap(self, pcontainer):
+        with self._lock:
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='container-reaper-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(pcontainer)
+
+    def _run(self):
+        while True:
+            pcontainer = self._queue.get()
+            start = timeit.default_timer()
+            try:
+                removed = pcontainer.destroy()
+                with self._lock:
+                    self.seconds += timeit.default_timer() - start
+                if removed:
+                    with self._lock:
+                        self.removed += 1
+                else:
+                    logging.error('Can not remove container "%s", it is removed at the end of the run' % pcontainer.container_name)
+                    with self._lock:
+                        self.failed.append(pcontainer.container_name)
+            except Exception as e:
+                logging.error('Can not remove container "%s": %s' % (pcontainer.container_name, e))
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """ Wait until all containers handed over are removed """
+        self._queue.join()
+
+    def stats(self):
+        """ Container removals of the run for summary.yml """
+        with self._lock:
+            return {'removed':self.removed, 'failed':len(self.failed), 'seconds':round(self.seconds, 3)}
+
+    def close(self):
+        """ Wait for removals, then remove containers created by this run still on the docker hosts """
+        self.wait()
+        for (docker_base_url, created) in self.created.items():
+            docker_client = get_docker_client(docker_base_url)
+            for container in docker_client.containers(all=True):
+                if container['Id'] not in created:
+                    continue
+                names = [name.lstrip('/') for name in container.get('Names') or []]
+                logging.info('Remove container left behind: %s' % ', '.join(names))
+                try:
+                    docker_client.remove_container(container['Id'], force=True)
+                except APIError as e:
+                    logging.error('Can not remove container "%s": %s' % (', '.join(names), e))
+
+_container_reaper = ContainerReaper()
+
+def get_container_reaper():
+    return _container_reaper
+
+class TestScheduler:
+    """ Run module tests on a fixed number of worker threads.
+        Workers spend their time waiting for docker API and ssh subprocesses,
+        so threads are enough to keep many containers busy from one process.
+        on_result is called as soon as a module test finished.
+        Once max_failures modules failed, queued tests are not started and on_cancel(reason)
+        is called to abort the running ones.
+    """
+    def __init__(self, concurrency, on_result=None, max_failures=None, on_cancel=None):
+        self.concurrency = concurrency
+        self.on_result = on_result
+        self.max_failures = max_failures
+        self.on_cancel = on_cancel
+        self.failures = 0
+        self.cancelled = None
+        self._lock = threading.Lock()
+
+    def _worker(self, tasks, results):
+        while True:
+            if self.cancelled:
+                return
+            try:
+                (module, task) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = task()
+            except Exception as e:
+                logging.error('Module "%s" test failed: %s' % (module, e))
+                result = {'puppet_module':module, 'task':None, 'retcode':1,
+                          'stdout':'', 'stderr':str(e), 'time':None}
+            self._add_result(results, result)
+
+    def _add_result(self, results, result):
+        cancel = None
+        with self._lock:
+            results.append(result)
+            if self.on_result:
+                try:
+                    self.on_result(result)
+                except Exception as e:
+                    logging.error('Can not process result of module "%s": %s' % (result['puppet_module'], e))
+            if not result.get('cancelled') and is_puppet_failed(result['retcode']):
+                self.failures += 1
+                if self.max_failures and self.failures >= self.max_failures and not self.cancelled:
+                    cancel = self.cancelled = 'Cancelled after %d module failures' % self.failures
+        if cancel:
+            logging.error('%s, cancel remaining module tests' % cancel)
+            if self.on_cancel:
+                self.on_cancel(cancel)
+
+    def run(self, tasks):
+        """ tasks is a list of (module, callable returning result) """
+        queue = Queue.Queue()
+        for task in tasks:
+            queue.put(task)
+        results = []
+        workers = []
+        for i in range(min(self.concurrency, len(tasks))):
+            worker = threading.Thread(target=self._worker, args=(queue, results), name='test-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            # join with timeout, otherwise KeyboardInterrupt is not delivered
+            while worker.is_alive():
+                worker.join(1)
+        while True:
+            try:
+                (module, task) = queue.get_nowait()
+            except Queue.Empty:
+                break
+            self._add_result(results, cancelled_result(module, self.cancelled))
+        return results
+
+def cancelled_result(module, reason):
+    return {'puppet_module':module, 'task':None, 'retcode':1, 'cancelled':True,
+            'stdout':'', 'stderr':reason, 'time':None}
+
 def is_puppet_failed(retcode):
     #exit code of '2' means there were changes,
     #an exit code of '4' means there were failures during the transaction,
@@ -306,6 +1564,451 @@ def is_puppet_failed(retcode):
     else:
         return False
 
+class RuntimeHistory:
+    """ Measured puppet apply time of every module, used to dispatch the modules expected to run longest first.
+        Runs on this host are read from RunHistory, see RunHistory.runtime_history(),
+        shards are balanced by runtimes.yml written by merge_reports() as executors do not share their history.
+    """
+    def __init__(self, path, samples=10, default_runtime=60.0):
+        self.path = path
+        self.samples = samples
+        self.default_runtime = default_runtime
+        self.runtimes = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.runtimes = yaml.safe_load(f) or {}
+
+    def record(self, module, seconds):
+        self.runtimes.setdefault(module, []).append(float(seconds))
+        self.runtimes[module] = self.runtimes[module][-self.samples:]
+
+    def expected(self, module):
+        if self.runtimes.get(module):
+            return median(self.runtimes[module])
+        # never timed - assume a typical module
+        known = [median(samples) for samples in self.runtimes.values() if samples]
+        if known:
+            return median(known)
+        return self.default_runtime
+
+    def longest_first(self, modules):
+        return sorted(modules, key=lambda module: (-self.expected(module), module))
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(yaml.safe_dump(self.runtimes, default_flow_style=False))
+        os.rename(self.path + '.tmp', self.path)
+
+class RunHistory:
+    """ Results of every run in a SQLite database, kept across runs.
+        Used to follow runtime of modules and to find modules that became slower.
+    """
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, commit_id TEXT, '
+              'base_image TEXT, modules INTEGER, failed INTEGER)',
+              'CREATE TABLE IF NOT EXISTS results (run_id INTEGER REFERENCES runs(id), module TEXT, '
+              'retcode INTEGER, puppet_failed INTEGER, time_seconds REAL, timings TEXT, cached INTEGER, '
+              'status TEXT, docker_host TEXT, stdout_sha1 TEXT, stderr_sha1 TEXT, memory_bytes INTEGER)',
+              'CREATE INDEX IF NOT EXISTS results_module ON results (module, run_id)']
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path)
+        with self._db:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(results)')]
+            if 'memory_bytes' not in columns:
+                # database written before memory use was recorded
+                self._db.execute('ALTER TABLE results ADD COLUMN memory_bytes INTEGER')
+
+    def add_run(self, results, started, commit=None, base_image=None):
+        """ Store results of a run started at datetime started, returns id of the run """
+        with self._db:
+            failed = len([result for result in results if is_puppet_failed(result['retcode'])])
+            run_id = self._db.execute('INSERT INTO runs (started, commit_id, base_image, modules, failed) VALUES (?, ?, ?, ?, ?)',
+                                      (started.isoformat(), commit, base_image, len(results), failed)).lastrowid
+            for result in results:
+                output = result.get('output') or {}
+                digests = [output[stream]['sha1'] if 'sha1' in output.get(stream, {}) else text_sha1(result.get(stream))
+                           for stream in ['stdout', 'stderr']]
+                if result.get('cancelled'):
+                    status = 'cancelled'
+                elif result.get('aborted'):
+                    status = 'aborted'
+                else:
+                    status = 'failed' if is_puppet_failed(result['retcode']) else 'passed'
+                puppet_failed = result.get('puppet_failed')
+                self._db.execute('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (run_id, result['puppet_module'], result['retcode'],
+                                  None if puppet_failed is None else int(puppet_failed),
+                                  result.get('time_seconds'), json.dumps(result.get('timings') or {}, sort_keys=True),
+                                  int(bool(result.get('cached'))), status, result.get('docker_host'),
+                                  digests[0], digests[1], result.get('memory_bytes')))
+        return run_id
+
+    def runtimes(self, modules=None, runs=10):
+        """ Apply times measured in the last runs of every module (cached and aborted results are skipped),
+            returns {module: [{'run', 'started', 'commit', 'time_seconds'}, ...]} oldest first.
+        """
+        query = ('SELECT results.module, runs.id, runs.started, runs.commit_id, results.time_seconds '
+                 'FROM results JOIN runs ON results.run_id = runs.id '
+                 'WHERE results.time_seconds IS NOT NULL AND results.cached = 0 AND results.status IN (\'passed\', \'failed\') '
+                 'ORDER BY runs.id DESC')
+        runtimes = {}
+        for (module, run_id, started, commit, time_seconds) in self._db.execute(query):
+            if modules and module not in modules:
+                continue
+            samples = runtimes.setdefault(module, [])
+            if len(samples) < runs:
+                samples.insert(0, {'run': run_id, 'started': started, 'commit': commit, 'time_seconds': time_seconds})
+        return runtimes
+
+    def runtime_history(self, samples=10):
+        """ RuntimeHistory with apply times of the last samples runs of every module """
+        runtime_history = RuntimeHistory(None, samples=samples)
+        for (module, runs) in self.runtimes(runs=samples).items():
+            runtime_history.runtimes[module] = [run['time_seconds'] for run in runs]
+        return runtime_history
+
+    def memory_footprints(self, runs=10):
+        """ Peak memory use of every module in its last runs, {module: bytes} """
+        query = 'SELECT module, memory_bytes FROM results WHERE memory_bytes IS NOT NULL ORDER BY run_id DESC'
+        samples = {}
+        for (module, memory_bytes) in self._db.execute(query):
+            if len(samples.setdefault(module, [])) < runs:
+                samples[module].append(memory_bytes)
+        return dict([(module, max(values)) for (module, values) in samples.items()])
+
+    def close(self):
+        self._db.close()
+
+def text_sha1(text):
+    if text is None:
+        return None
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+def runtime_regressions(runtimes, threshold=1.5, min_seconds=5.0):
+    """ Modules whose last apply time is over threshold times the median of the runs before it.
+        Modules faster than min_seconds over the median are left out, short runs vary too much.
+    """
+    regressions = []
+    for module in sorted(runtimes):
+        samples = runtimes[module]
+        if len(samples) < 2:
+            continue
+        last = samples[-1]['time_seconds']
+        baseline = median([sample['time_seconds'] for sample in samples[:-1]])
+        if last > baseline * threshold and last - baseline >= min_seconds:
+            regressions.append({'module': module, 'time_seconds': last, 'median': baseline,
+                                'ratio': round(last / baseline, 2) if baseline else None,
+                                'run': samples[-1]['run'], 'commit': samples[-1]['commit']})
+    return regressions
+
+def history_report(history, modules=None, runs=10, threshold=1.5):
+    """ Print runtime trend of modules, returns 1 when the last run of a module regressed """
+    runtimes = history.runtimes(modules, runs=runs + 1)
+    if not runtimes:
+        print('No runs recorded in %s' % history.path)
+        return 0
+    print('%-30s %5s %9s %9s %9s %9s  %s' % ('module', 'runs', 'last', 'median', 'min', 'max', 'trend (oldest first)'))
+    for module in sorted(runtimes):
+        times = [sample['time_seconds'] for sample in runtimes[module]]
+        print('%-30s %5d %8.1fs %8.1fs %8.1fs %8.1fs  %s' % (module, len(times), times[-1], median(times), min(times), max(times),
+                                                           ' '.join(['%.0f' % seconds for seconds in times])))
+    regressions = runtime_regressions(runtimes, threshold=threshold)
+    for regression in regressions:
+        print('REGRESSION %(module)s: %(time_seconds).1fs, median of previous runs %(median).1fs (commit %(commit)s)' % regression)
+    return 1 if regressions else 0
+
+def parse_shard(value):
+    """ Parse I/N shard definition, returns (I, N) """
+    try:
+        (shard, shards) = [int(number) for number in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be I/N, e.g. 1/4: %s' % value)
+    if shards < 1 or not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError('shard I/N must have 1 <= I <= N: %s' % value)
+    return (shard, shards)
+
+def shard_modules(modules, shard, shards, runtime_history):
+    """ Modules of shard I of N: modules expected to run longest are placed first,
+        every one on the shard with the least expected runtime so far.
+        Executors with the same modules and runtime history get the same shards.
+        Returns (modules of the shard, expected runtime of every shard).
+    """
+    loads = [0.0] * shards
+    assigned = [[] for index in range(shards)]
+    for module in runtime_history.longest_first(modules):
+        index = min(range(shards), key=lambda index: (loads[index], index))
+        loads[index] += runtime_history.expected(module)
+        assigned[index].append(module)
+    return (sorted(assigned[shard - 1]), loads)
+
+# files outside of module directories affecting every puppet run
+PUPPET_RUN_INPUTS = ['hieradata', 'hiera.yaml', 'manifests/site.pp']
+
+def hash_paths(paths, root, digest=None):
+    """ sha1 of names and content of files under paths (relative to root) """
+    if digest is None:
+        digest = hashlib.sha1()
+    for path in sorted(paths):
+        full_path = os.path.join(root, path)
+        if os.path.isdir(full_path):
+            file_paths = []
+            for (dirpath, dirnames, filenames) in os.walk(full_path):
+                file_paths.extend([os.path.join(dirpath, filename) for filename in filenames])
+        else:
+            file_paths = [full_path]
+        for file_path in sorted(file_paths):
+            if not os.path.isfile(file_path):
+                continue
+            digest.update(os.path.relpath(file_path, root).encode('utf-8') + b'\0')
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+    return digest
+
+class PackageCache:
+    """ Yum packages shared by all test containers and an optional local mirror (directory with a yum repository).
+        Package downloaded by one container is installed from the cache by all others.
+        Only 'packages' directories of the repositories are shared, repository metadata and
+        its sqlite files stay in the yum cache of every container.
+    """
+    CONTAINER_CACHE_DIR = '/var/cache/yum'
+    CONTAINER_PACKAGES_DIR = '/var/cache/puppet_test_packages'
+    CONTAINER_MIRROR_DIR = '/var/cache/puppet_test_mirror'
+    CONTAINER_REPO_FILE = '/etc/yum.repos.d/puppet_test_mirror.repo'
+
+    def __init__(self, cache_dir, mirror_dir=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.mirror_dir = os.path.abspath(mirror_dir) if mirror_dir else None
+        self.repo_file_path = self.cache_dir + '.repo'
+        self._start_packages = None
+
+    def setup(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if self.mirror_dir:
+            # repos of the image stay enabled, the mirror is preferred by its lower cost
+            with open(self.repo_file_path, 'w') as f:
+                f.write('[puppet_test_mirror]\n'
+                        'name=puppet_test local mirror\n'
+                        'baseurl=file://%s\n'
+                        'enabled=1\n'
+                        'gpgcheck=0\n'
+                        'cost=1\n'
+                        'metadata_expire=0\n' % self.CONTAINER_MIRROR_DIR)
+        self._start_packages = self.packages()
+        return self
+
+    def binds(self):
+        binds = {self.cache_dir: self.CONTAINER_PACKAGES_DIR}
+        if self.mirror_dir:
+            binds[self.mirror_dir] = self.CONTAINER_MIRROR_DIR
+            binds[self.repo_file_path] = self.CONTAINER_REPO_FILE
+        return binds
+
+    def prepare_command(self):
+        # yum removes packages after install by default, no single quotes: command may be passed over ssh.
+        # cache of every repository is kept in CONTAINER_CACHE_DIR/<repo>, its 'packages' is linked to the shared one
+        return ("(grep -q ^keepcache= /etc/yum.conf || echo keepcache=1 >> /etc/yum.conf) && "
+                "sed -i s/^keepcache=0/keepcache=1/ /etc/yum.conf && "
+                "(grep -q ^cachedir= /etc/yum.conf || echo cachedir=%(cache)s >> /etc/yum.conf) && "
+                "sed -i \"s|^cachedir=.*|cachedir=%(cache)s|\" /etc/yum.conf && "
+                "for repo in $(sed -n \"s/^\\[\\(.*\\)\\]\\s*$/\\1/p\" /etc/yum.repos.d/*.repo); do "
+                "mkdir -p %(packages)s/$repo %(cache)s/$repo && ln -sfn %(packages)s/$repo %(cache)s/$repo/packages; done"
+                % {'cache': self.CONTAINER_CACHE_DIR, 'packages': self.CONTAINER_PACKAGES_DIR})
+
+    def packages(self):
+        """ {path: size} of packages in the cache """
+        packages = {}
+        for path in find_files(self.cache_dir, '*.rpm'):
+            try:
+                packages[os.path.relpath(path, self.cache_dir)] = os.path.getsize(path)
+            except OSError:
+                # removed by yum of a running container
+                pass
+        return packages
+
+    def stats(self, results):
+        """ Cache use of this run """
+        packages = self.packages()
+        downloaded = set(packages) - set(self._start_packages or {})
+        installed = sum([result.get('packages', {}).get('installed', 0) for result in results if not result.get('cached')])
+        return {'cache_dir': self.cache_dir,
+                'mirror_dir': self.mirror_dir,
+                'packages_cached': len(packages),
+                'cache_bytes': sum(packages.values()),
+                'packages_installed': installed,
+                'packages_downloaded': len(downloaded),
+                'downloaded_bytes': sum([packages[package] for package in downloaded]),
+                # installs served by the cache or the mirror
+                'packages_local': max(installed - len(downloaded), 0)}
+
+class ResultCache:
+    """ Results and logs of successful module runs, keyed by a hash of
+        module sources, global puppet inputs, run options and base image id.
+        Least recently used entries are evicted above max_entries.
+    """
+    def __init__(self, cache_dir, max_entries=500):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # digest of PUPPET_RUN_INPUTS by puppet directory, they are the same for all modules of a run
+        self._inputs_digests = {}
+
+    def key(self, module, puppet_dir, image_id, dependencies=(), options=None):
+        """ options is a json serializable value of run options changing the outcome of the run """
+        if puppet_dir not in self._inputs_digests:
+            self._inputs_digests[puppet_dir] = hash_paths(PUPPET_RUN_INPUTS, puppet_dir)
+        digest = self._inputs_digests[puppet_dir].copy()
+        hash_paths([os.path.join('modules', name) for name in set(dependencies) | set([module])], puppet_dir, digest)
+        digest.update(module.encode('utf-8') + b'\0' + str(image_id).encode('utf-8'))
+        if options is not None:
+            digest.update(b'\0' + json.dumps(options, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key, module_report_dir_path):
+        """ Restore cached logs into module_report_dir_path, returns cached result or None """
+        entry_path = os.path.join(self.cache_dir, key)
+        result_yaml_file_path = os.path.join(entry_path, 'result.yml')
+        if not os.path.exists(result_yaml_file_path):
+            self.misses += 1
+            return None
+        with open(result_yaml_file_path) as f:
+            result = yaml.safe_load(f)
+        if not os.path.exists(module_report_dir_path):
+            os.makedirs(module_report_dir_path)
+        for log_file in sorted(LOG_FILE_NAMES.values()):
+            if os.path.exists(os.path.join(entry_path, log_file)):
+                shutil.copy(os.path.join(entry_path, log_file), module_report_dir_path)
+        for stream in ['stdout', 'stderr']:
+            if stream in result.get('output', {}):
+                result['output'][stream]['log'] = module_log_path(module_report_dir_path, stream)
+        result['cached'] = True
+        # mark entry as recently used
+        os.utime(entry_path, None)
+        self.hits += 1
+        return result
+
+    def put(self, key, result, module_report_dir_path):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entry_path = os.path.join(self.cache_dir, key)
+        tmp_entry_path = tempfile.mkdtemp(dir=self.cache_dir)
+        for log_file in sorted(LOG_FILE_NAMES.values()):
+            if os.path.exists(os.path.join(module_report_dir_path, log_file)):
+                shutil.copy(os.path.join(module_report_dir_path, log_file), tmp_entry_path)
+        with open(os.path.join(tmp_entry_path, 'result.yml'), 'w') as f:
+            f.write(yaml.safe_dump(result, default_flow_style=False))
+        if os.path.exists(entry_path):
+            shutil.rmtree(entry_path)
+        os.rename(tmp_entry_path, entry_path)
+
+    def evict(self):
+        if not os.path.exists(self.cache_dir):
+            return
+        entries = [os.path.join(self.cache_dir, entry) for entry in os.listdir(self.cache_dir)]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry_path in entries[self.max_entries:]:
+            logging.debug('Evict cached result: %s' % entry_path)
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+def docker_image_id(docker_client, image):
+    inspect = docker_client.inspect_image(image)
+    return inspect.get('Id', inspect.get('id'))
+
+def docker_image_exists(docker_client, image):
+    try:
+        docker_client.inspect_image(image)
+    except APIError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+    return True
+
+def docker_image_tags(docker_client, repository):
+    tags = []
+    for image in docker_client.images(repository):
+        if 'RepoTags' in image:
+            tags.extend([repo_tag.split(':', 1)[1] for repo_tag in image['RepoTags'] or []
+                         if repo_tag.split(':', 1)[0] == repository])
+        elif image.get('Repository') == repository:
+            tags.append(image['Tag'])
+    return tags
+
+class BaseImageRegistry:
+    """ Base images tagged with a fingerprint of their inputs.
+        Base image is rebuilt only when the fingerprint changes,
+        least recently used fingerprints are removed by collect_garbage().
+    """
+    def __init__(self, state_path, repository='spil/slc-puppet-base', tag_prefix='6.5', keep=3):
+        self.state_path = state_path
+        self.repository = repository
+        self.tag_prefix = tag_prefix
+        self.keep = keep
+        self.last_used = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.last_used = yaml.safe_load(f) or {}
+
+    def fingerprint_tag(self, puppet_dir, base_modules, parent_image_id):
+        """ Tag of the base image built from the base role modules, global puppet inputs and parent image """
+        digest = hash_paths(PUPPET_RUN_INPUTS + [os.path.join('modules', module) for module in base_modules], puppet_dir)
+        digest.update(str(parent_image_id).encode('utf-8'))
+        return '%s-%s' % (self.tag_prefix, digest.hexdigest()[:12])
+
+    def image(self, tag):
+        return '%s:%s' % (self.repository, tag)
+
+    def latest_tag(self, docker_client):
+        """ Most recently used fingerprinted base image still present in docker """
+        tags = [tag for tag in docker_image_tags(docker_client, self.repository) if tag.startswith(self.tag_prefix + '-')]
+        if not tags:
+            return None
+        return max(tags, key=lambda tag: self.last_used.get(tag, 0))
+
+    def touch(self, tag):
+        self.last_used[tag] = time.time()
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.state_path + '.tmp', 'w') as f:
+            f.write(yaml.safe_dump(self.last_used, default_flow_style=False))
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def collect_garbage(self, docker_client, current_tag):
+        tags = [tag for tag in docker_image_tags(docker_client, self.repository)
+                if tag.startswith(self.tag_prefix + '-') and tag != current_tag]
+        tags.sort(key=lambda tag: self.last_used.get(tag, 0), reverse=True)
+        for tag in tags[max(self.keep - 1, 0):]:
+            logging.info('Remove least recently used base image: %s' % self.image(tag))
+            try:
+                docker_client.remove_image(self.image(tag))
+            except APIError as e:
+                # image may still be used by a container of another run
+                logging.info('Can not remove base image %s: %s' % (self.image(tag), e.explanation))
+                continue
+            self.last_used.pop(tag, None)
+        self.touch(current_tag)
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
 def find_files(directory, pattern):
     for root, dirs, files in os.walk(directory):
         for basename in files:
@@ -346,18 +2049,399 @@ def jenkins_build_files_changed():
         raise Exception('Can not get git commits', cmd, stdout, stderr)
     return stdout.split()
 
-def jenkins_build_puppet_modules_changed():
-    files_changed = jenkins_build_files_changed()
+# bumped when parse_puppet_manifest() finds more, manifests indexed by an older parser are parsed again
+PUPPET_PARSER_VERSION = 2
+PUPPET_COMMENT_RE = re.compile(r'#[^\n]*')
+PUPPET_DEFINITION_RE = re.compile(r'^\s*(?:class|define)\s+(?:::)?([a-z][\w:]*)', re.M)
+PUPPET_INCLUDE_RE = re.compile(r'\b(?:include|require|contain|hiera_include)\s+([^\n;{}()]+)')
+PUPPET_CLASS_RESOURCE_RE = re.compile(r'\bclass\s*\{\s*[\'"](?:::)?([^\'"]+)[\'"]')
+PUPPET_CLASS_REFERENCE_RE = re.compile(r'\bClass\s*\[\s*[\'"]?(?:::)?([\w:]+)')
+PUPPET_DEFINED_TYPE_RE = re.compile(r'^\s*(?:::)?([a-z]\w*(?:::\w+)+)\s*\{', re.M)
+PUPPET_INHERITS_RE = re.compile(r'\binherits\s+(?:::)?([\w:]+)')
+PUPPET_QUALIFIED_VARIABLE_RE = re.compile(r'\$\{?(?:::)?([a-z]\w*)::\w')
+PUPPET_HIERA_LOOKUP_RE = re.compile(r'\bhiera(?:_array|_hash)?\s*\(\s*[\'"]([^\'"]+)[\'"]')
+
+def puppet_name_module(name):
+    """ Module of a class or defined type name, None for names built at runtime """
+    module = name.strip().strip('\'"').lstrip(':').split('::')[0]
+    if not module or '$' in module or not re.match(r'^[a-z]\w*$', module):
+        return None
+    return module
+
+def puppet_references(content):
+    """ Modules referenced by manifest content: included, declared, inherited classes and qualified variables
+
+    >>> puppet_references('class a inherits b::params { $x = $c::params::y notify { "${d::z} $::fqdn": } }')
+    ['b', 'c', 'd']
+    >>> puppet_references('class a::server inherits a { include e, f::g }')
+    ['a', 'e', 'f']
+    """
+    references = set()
+    for names in PUPPET_INCLUDE_RE.findall(content):
+        references.update([puppet_name_module(name) for name in names.split(',')])
+    for regexp in [PUPPET_CLASS_RESOURCE_RE, PUPPET_CLASS_REFERENCE_RE, PUPPET_DEFINED_TYPE_RE,
+                   PUPPET_INHERITS_RE, PUPPET_QUALIFIED_VARIABLE_RE]:
+        references.update([puppet_name_module(name) for name in regexp.findall(content)])
+    references.discard(None)
+    return sorted(references)
+
+def parse_puppet_manifest(path):
+    """ Classes/defines declared in manifest, modules it references and hiera keys it looks up """
+    with open(path) as f:
+        content = PUPPET_COMMENT_RE.sub('', f.read())
+    return {'defines': sorted(set(PUPPET_DEFINITION_RE.findall(content))),
+            'references': puppet_references(content),
+            'lookups': sorted(set(PUPPET_HIERA_LOOKUP_RE.findall(content)))}
+
+class PuppetDependencyIndex:
+    """ Module dependencies parsed from .pp manifests.
+        Index is persisted in the state dir, only manifests with a changed mtime are parsed again.
+    """
+    def __init__(self, puppet_dir, index_path):
+        self.puppet_dir = puppet_dir
+        self.index_path = index_path
+        self.manifests = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.manifests = json.load(f)
+
+    def update(self):
+        manifests = {}
+        parsed = 0
+        for directory in ['modules', 'manifests']:
+            for path in find_files(os.path.join(self.puppet_dir, directory), '*.pp'):
+                relpath = os.path.relpath(path, self.puppet_dir)
+                mtime = os.path.getmtime(path)
+                manifest = self.manifests.get(relpath)
+                if not manifest or manifest['mtime'] != mtime or manifest.get('parser') != PUPPET_PARSER_VERSION:
+                    manifest = parse_puppet_manifest(path)
+                    manifest['mtime'] = mtime
+                    manifest['parser'] = PUPPET_PARSER_VERSION
+                    parsed += 1
+                manifests[relpath] = manifest
+        self.manifests = manifests
+        logging.debug('Dependency index: %d manifests, %d parsed' % (len(manifests), parsed))
+        return self
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.manifests, f)
+        os.rename(self.index_path + '.tmp', self.index_path)
+
+    def module_of_path(self, relpath):
+        parts = relpath.split('/')
+        if len(parts) > 2 and parts[0] == 'modules':
+            return parts[1]
+        return None
+
+    def dependencies(self):
+        """ module -> modules it references """
+        dependencies = {}
+        for (relpath, manifest) in self.manifests.items():
+            module = self.module_of_path(relpath)
+            if module:
+                references = dependencies.setdefault(module, set())
+                references.update([reference for reference in manifest['references'] if reference != module])
+        return dependencies
+
+    def dependencies_closure(self, modules):
+        """ modules and everything they depend on, directly or not """
+        dependencies = self.dependencies()
+        closure = set()
+        pending = list(modules)
+        while pending:
+            module = pending.pop()
+            if module in closure:
+                continue
+            closure.add(module)
+            pending.extend(dependencies.get(module, []))
+        return closure
+
+    def dependents_closure(self, modules):
+        """ modules and everything depending on them, directly or not """
+        dependents = {}
+        for (module, references) in self.dependencies().items():
+            for reference in references:
+                dependents.setdefault(reference, set()).add(module)
+        closure = set()
+        pending = list(modules)
+        while pending:
+            module = pending.pop()
+            if module in closure:
+                continue
+            closure.add(module)
+            pending.extend(dependents.get(module, []))
+        return closure
+
+    def site_modules(self):
+        """ modules applied by manifests/ for every test (the base role) """
+        references = set()
+        for (relpath, manifest) in self.manifests.items():
+            if relpath.startswith('manifests/'):
+                references.update(manifest['references'])
+        return self.dependencies_closure(references)
+
+    def hiera_key_modules(self, keys):
+        """ modules affected by hiera keys, None if some key can not be attributed to a module """
+        modules = set()
+        lookups = {}
+        for (relpath, manifest) in self.manifests.items():
+            for key in manifest.get('lookups', []):
+                lookups.setdefault(key, set()).add(self.module_of_path(relpath))
+        for key in keys:
+            if key in lookups:
+                if None in lookups[key]:
+                    return None
+                modules.update(lookups[key])
+            elif '::' in key:
+                # automatic class parameter lookup
+                modules.add(key.lstrip(':').split('::')[0])
+            else:
+                return None
+        return modules
+
+def load_hiera_data(content):
+    data = yaml.safe_load(content) if content else {}
+    if not isinstance(data, dict):
+        raise ValueError('not a hash')
+    return data
+
+def load_hiera_file(puppet_dir, relpath):
+    path = os.path.join(puppet_dir, relpath)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return load_hiera_data(f.read())
+
+def hiera_keys_diff(previous, current):
+    return set([key for key in set(current) | set(previous) if current.get(key) != previous.get(key)])
+
+def hieradata_keys_changed(puppet_dir, relpath, git_previous_commit):
+    """ Top level hiera keys with a different value in git_previous_commit, None if unknown """
+    try:
+        current = load_hiera_file(puppet_dir, relpath)
+        (retcode, previous_content, stderr) = run_and_capture_output(
+            "git show %s:%s" % (git_previous_commit, relpath), ignore_error=True)
+        previous = load_hiera_data(previous_content) if retcode == 0 else {}
+    except Exception as e:
+        logging.info('Can not compare hiera keys of "%s": %s' % (relpath, e))
+        return None
+    return hiera_keys_diff(previous, current)
+
+def puppet_modules_affected(files_changed, index, tested_modules, hiera_keys_changed):
+    """ Modules with tests affected by changed files: changed modules,
+        modules using changed hiera keys and everything depending on them.
+        hiera_keys_changed(relpath) returns hiera keys changed in the file or None if unknown.
+    """
+    tested_modules = set(tested_modules)
     modules_changed = set()
-    for file in files_changed:
-        if file.startswith('modules'):
+    for relpath in files_changed:
+        module = index.module_of_path(relpath)
+        if module:
+            modules_changed.add(module)
+        elif relpath.startswith('hieradata/'):
+            keys = hiera_keys_changed(relpath)
+            modules = index.hiera_key_modules(keys) if keys is not None else None
+            if modules is None:
+                logging.info('Changed hiera data can not be mapped to modules: %s' % relpath)
+                return tested_modules
+            modules_changed.update(modules)
+        elif relpath in PUPPET_RUN_INPUTS or relpath.startswith('manifests/'):
+            logging.info('Global puppet input changed: %s' % relpath)
+            return tested_modules
+    if modules_changed & index.site_modules():
+        logging.info('Modules applied to every test changed: %s' % sorted(modules_changed & index.site_modules()))
+        return tested_modules
+    logging.info('Puppet modules changed: %s' % sorted(modules_changed))
+    return index.dependents_closure(modules_changed) & tested_modules
+
+def jenkins_build_puppet_modules_affected(index, tested_modules):
+    files_changed = jenkins_build_files_changed()
+    git_previous_commit = os.environ['GIT_PREVIOUS_COMMIT']
+    return puppet_modules_affected(files_changed, index, tested_modules,
+                                   lambda relpath: hieradata_keys_changed(index.puppet_dir, relpath, git_previous_commit))
+
+# directories of the puppet tree --watch looks for changes in
+WATCH_DIRECTORIES = ['modules', 'hieradata', 'manifests']
+
+def watched_file(path):
+    # editors write swap and backup files next to the edited one
+    name = os.path.basename(path)
+    return not (name.startswith('.') or name.endswith('~') or name.endswith('.swp'))
+
+class PuppetTreeWatcher:
+    """ Files changed under WATCH_DIRECTORIES of the puppet tree.
+        Uses inotify when pyinotify is installed, modification times are polled otherwise.
+    """
+    def __init__(self, puppet_dir, interval=1.0, settle=0.5):
+        self.puppet_dir = os.path.abspath(puppet_dir)
+        self.interval = interval
+        # changes are collected until files were not written for settle seconds
+        self.settle = settle
+        self._changed = set()
+        self._condition = threading.Condition()
+        if pyinotify:
+            watch_manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+            for directory in WATCH_DIRECTORIES:
+                if os.path.isdir(os.path.join(self.puppet_dir, directory)):
+                    watch_manager.add_watch(os.path.join(self.puppet_dir, directory), mask, rec=True, auto_add=True)
+            self._notifier = pyinotify.ThreadedNotifier(watch_manager, default_proc_fun=self._on_event)
+            self._notifier.daemon = True
+            self._notifier.start()
+        else:
+            self._mtimes = self._scan()
+
+    def _on_event(self, event):
+        if event.dir or not watched_file(event.pathname):
+            return
+        with self._condition:
+            self._changed.add(os.path.relpath(event.pathname, self.puppet_dir))
+            self._condition.notify()
+
+    def _scan(self):
+        mtimes = {}
+        for directory in WATCH_DIRECTORIES:
+            for (root, dirs, files) in os.walk(os.path.join(self.puppet_dir, directory)):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if watched_file(path):
+                        try:
+                            mtimes[os.path.relpath(path, self.puppet_dir)] = os.path.getmtime(path)
+                        except OSError:
+                            pass
+        return mtimes
+
+    def _collect(self):
+        """ Paths changed since the last call """
+        if not pyinotify:
+            mtimes = self._scan()
+            changed = [relpath for relpath in set(mtimes) | set(self._mtimes) if mtimes.get(relpath) != self._mtimes.get(relpath)]
+            self._mtimes = mtimes
+            with self._condition:
+                self._changed.update(changed)
+        with self._condition:
+            changed = self._changed
+            self._changed = set()
+        return changed
+
+    def wait(self):
+        """ Block until files change, returns paths relative to the puppet dir """
+        changed = set()
+        while not changed:
+            if pyinotify:
+                with self._condition:
+                    # wait with timeout, otherwise KeyboardInterrupt is not delivered
+                    if not self._changed:
+                        self._condition.wait(self.interval)
+            else:
+                time.sleep(self.interval)
+            changed = self._collect()
+        # editors and git write several files, collect changes until they settle
+        while True:
+            time.sleep(self.settle)
+            more = self._collect()
+            if not more:
+                break
+            changed.update(more)
+        return sorted(changed)
+
+class HieraSnapshot:
+    """ Content of hieradata files as it was applied last, to find hiera keys changed since """
+    def __init__(self, puppet_dir):
+        self.puppet_dir = puppet_dir
+        self.data = {}
+        for path in find_files(os.path.join(puppet_dir, 'hieradata'), '*.yaml'):
+            relpath = os.path.relpath(path, puppet_dir)
             try:
-                module = file.split('/')[1]
-                modules_changed.add(module)
-            except IndexError:
-                pass
-    logging.info('Puppet modules changed: %s' % modules_changed)
-    return modules_changed
+                self.data[relpath] = load_hiera_file(puppet_dir, relpath)
+            except Exception as e:
+                logging.info('Can not load hiera data "%s": %s' % (relpath, e))
+
+    def keys_changed(self, relpath):
+        try:
+            current = load_hiera_file(self.puppet_dir, relpath)
+        except Exception as e:
+            logging.info('Can not compare hiera keys of "%s": %s' % (relpath, e))
+            return None
+        keys = hiera_keys_diff(self.data.get(relpath, {}), current)
+        self.data[relpath] = current
+        return keys
+
+def watch_modules(modules, container_factory, dependency_index, watcher, concurrency=1, on_result=None):
+    """ Keep a container per module, apply puppet in it and again every time files
+        affecting the module change, until interrupted. Returns the last result of every module.
+    """
+    pcontainers = {}
+    def drop(module):
+        # removed right away, not by the reaper: the next boot reuses the container name
+        pcontainers.pop(module).destroy()
+
+    def running(pcontainer):
+        try:
+            return pcontainer.docker_client.inspect_container(pcontainer.container_name)['State']['Running']
+        except APIError:
+            return False
+
+    def apply(module):
+        pcontainer = pcontainers.get(module)
+        if pcontainer is not None and not running(pcontainer):
+            logging.info('Container "%s" is not running, boot it again' % pcontainer.container_name)
+            drop(module)
+            pcontainer = None
+        if pcontainer is None:
+            pcontainer = container_factory(module)
+            pcontainer.remove()
+            failure = pcontainer.boot()
+            if failure:
+                pcontainer.destroy()
+                return failure
+            pcontainers[module] = pcontainer
+        try:
+            result = pcontainer.apply()
+        except Exception as e:
+            # container is booted again on the next change
+            logging.error('Module "%s" failed in container "%s": %s' % (module, pcontainer.container_name, e))
+            drop(module)
+            return {'puppet_module':module, 'task':None, 'retcode':1,
+                    'stdout':'', 'stderr':str(e), 'time':None}
+        if pcontainer.aborted:
+            # abort() killed the container, boot it again on the next change
+            drop(module)
+        result.setdefault('timings', {}).update(pcontainer.timings)
+        return result
+
+    def apply_all(modules):
+        scheduler = TestScheduler(concurrency, on_result=on_result)
+        for result in scheduler.run([(module, functools.partial(apply, module)) for module in sorted(modules)]):
+            results[result['puppet_module']] = result
+            results_pretty_print([result])
+
+    results = {}
+    hiera_snapshot = HieraSnapshot(dependency_index.puppet_dir)
+    try:
+        apply_all(modules)
+        while True:
+            logging.info('Watching %s of "%s" for changes of modules %s, Ctrl-C to stop' % (
+                         ', '.join(WATCH_DIRECTORIES), dependency_index.puppet_dir, ', '.join(sorted(modules))))
+            changed = watcher.wait()
+            logging.info('Changed: %s' % ', '.join(changed))
+            dependency_index.update()
+            affected = puppet_modules_affected(changed, dependency_index, modules, hiera_snapshot.keys_changed)
+            if affected:
+                apply_all(affected)
+            else:
+                logging.info('No watched module is affected')
+    except KeyboardInterrupt:
+        logging.info('Stop watching')
+    finally:
+        for pcontainer in pcontainers.values():
+            get_container_reaper().reap(pcontainer)
+        get_container_reaper().wait()
+    return [results[module] for module in sorted(results)]
 
 def git_is_inside_work_tree():
     try:
@@ -370,15 +2454,106 @@ def git_is_inside_work_tree():
         return False
     return True
 
+def git_head_commit():
+    try:
+        (retcode, stdout, stderr) = run_and_capture_output('git rev-parse HEAD', ignore_error=True)
+    except OSError:
+        return None
+    if retcode != 0:
+        return None
+    return to_text(stdout).strip()
+
+def puppet_is_installed():
+    try:
+        (retcode, stdout, stderr) = run_and_capture_output('puppet --version', ignore_error=True)
+    except OSError:
+        logging.error("Error: unable to find \"puppet\" executable, check if \"puppet\" installed")
+        return False
+    return retcode == 0
+
+def prescreen_hiera_config(puppet_dir, hiera_config_path):
+    """ Copy of hiera.yaml resolving data from the hieradata of puppet_dir,
+        inside containers it is linked to /etc/puppet/hieradata instead.
+    """
+    with open(os.path.join(puppet_dir, 'hiera.yaml')) as f:
+        hiera_config = f.read()
+    # keep the rest of the file as is, hiera expects ruby symbols as keys
+    hiera_config = re.sub(r'(?m)^(\s*:datadir:).*$', r"\1 '%s'" % os.path.join(os.path.abspath(puppet_dir), 'hieradata'), hiera_config)
+    with open(hiera_config_path, 'w') as f:
+        f.write(hiera_config)
+    return hiera_config_path
+
+def prescreen_module(prescreen_task):
+    """ Validate manifests of the module and compile its catalog with the facts of a container run.
+        Runs in a worker process of prescreen_modules().
+    """
+    (module, puppet_dir, hiera_config_path, role) = prescreen_task
+    time_start = datetime.datetime.now().replace(microsecond=0)
+    timings = {}
+    env = dict(os.environ)
+    # same facts as prepare_puppet_command()
+    env.update({'FACTER_module': module, 'FACTER_platform': 'lxc',
+                'FACTER_spil_environment': 'puppet_test', 'FACTER_role': role})
+    manifests = sorted(find_files(os.path.join(puppet_dir, 'modules', module, 'manifests'), '*.pp'))
+    puppet_dirs = tempfile.mkdtemp(prefix='puppet_test_prescreen_')
+    commands = [('validate', "puppet parser validate --color false %s" % ' '.join(manifests)),
+             ('compile', "puppet master --compile puppet-test-%(module)s --color false --confdir %(tmp)s --vardir %(tmp)s "
+                         "--manifest %(puppet_dir)s/manifests/site.pp --modulepath %(puppet_dir)s/modules "
+                         "--hiera_config %(hiera_config)s --facts_terminus facter"
+                         % {'module': module, 'tmp': puppet_dirs, 'puppet_dir': os.path.abspath(puppet_dir),
+                            'hiera_config': hiera_config_path})]
+    try:
+        for (phase, task) in commands:
+            if phase == 'validate' and not manifests:
+                continue
+            with timed_phase(timings, phase):
+                (retcode, stdout, stderr) = run_and_capture_output(task, ignore_error=True, env=env)
+            if retcode != 0:
+                break
+    finally:
+        shutil.rmtree(puppet_dirs, ignore_errors=True)
+    time_delta = datetime.datetime.now().replace(microsecond=0) - time_start
+    return {'puppet_module': module,
+            'puppet_failed': retcode != 0,
+            'prescreen': phase,
+            'task': task, 'retcode': retcode,
+            'stdout': to_text(stdout) if retcode != 0 else '', 'stderr': to_text(stderr),
+            'time': str(time_delta),
+            'timings': timings}
+
+def prescreen_modules(puppet_modules, puppet_dir, processes=None, role='base'):
+    """ Pre-screen modules without containers in a pool of processes,
+        yields results as soon as every module is checked.
+    """
+    work_dir = tempfile.mkdtemp(prefix='puppet_test_prescreen_')
+    workers = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        hiera_config_path = prescreen_hiera_config(puppet_dir, os.path.join(work_dir, 'hiera.yaml'))
+        tasks = [(module, puppet_dir, hiera_config_path, role) for module in puppet_modules]
+        for result in workers.imap_unordered(prescreen_module, tasks):
+            yield result
+        workers.close()
+    finally:
+        workers.terminate()
+        workers.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
 def results_pretty_print(results):
     for result in results:
         logging.info("====================================================================")
         logging.info("  Module: %s" % result['puppet_module'])
         logging.info("  Retcode: %s" % result['retcode'])
         logging.info("  Runtime: %s" % result['time'])
+        if result.get('docker_host'):
+            logging.info("  Docker host: %s" % result['docker_host'])
 
-        if is_puppet_failed(result['retcode']):
+        if result.get('cancelled'):
+            logging.info("  Result: CANCELLED")
+            logging.info("  Reason: %s" % result.get('aborted', result['stderr']))
+        elif is_puppet_failed(result['retcode']):
             logging.info("  Result: FAILED")
+            if result.get('aborted'):
+                logging.info("  Aborted: %s" % result['aborted'])
             logging.info("  Task: %s" % result['task'])
             logging.info("  Stdout: ")
             logging.info(result['stdout'])
@@ -389,50 +2564,256 @@ def results_pretty_print(results):
 
         logging.info("====================================================================")
 
-def results_save_report(results, reports_dir=os.getcwd(), do_render_html=False, template_dir=None):
-    #result = {'puppet_module':self.puppet_facter_module, 'task':None, 'retcode':1, 'stdout':None, 'stderr':stderr, 'time':None}
-    report_dir_path = os.path.abspath(os.path.join(reports_dir,'reports'))
-    report_html_dir_path = os.path.abspath(os.path.join(report_dir_path,'html'))
-    logging.info("Reports dir: '%s'" % report_dir_path)
-    if os.path.exists(report_dir_path):
-        shutil.rmtree(report_dir_path)
-    if not os.path.exists(report_dir_path):
-        os.makedirs(report_dir_path)
-    for result in results:
-        module_report_dir_path = os.path.join(report_dir_path, result['puppet_module'])
-        stderr_log_file_path = os.path.abspath(os.path.join(module_report_dir_path,'stderr.txt'))
-        stdout_log_file_path = os.path.abspath(os.path.join(module_report_dir_path,'stdout.txt'))
-        result_yaml_file_path = os.path.abspath(os.path.join(module_report_dir_path,'result.yml'))
-        if not os.path.exists(module_report_dir_path):
-            os.makedirs(module_report_dir_path)
-        with open(stderr_log_file_path,'w') as f:
-            f.write(result['stderr'])
-        with open(stdout_log_file_path,'w') as f:
-            f.write(result['stdout'])
-
-        with open(result_yaml_file_path,'w') as f:
-            f.write(yaml.dump(result, default_flow_style=False))
+LOG_FILE_NAMES = {'stdout': 'stdout.txt.gz', 'stderr': 'stderr.txt.gz'}
+
+def module_log_path(module_report_dir_path, stream):
+    return os.path.abspath(os.path.join(module_report_dir_path, LOG_FILE_NAMES[stream]))
+
+def results_save_module_report(result, reports_dir=os.getcwd()):
+    module_report_dir_path = module_report_dir(reports_dir, result['puppet_module'])
+    result_yaml_file_path = os.path.abspath(os.path.join(module_report_dir_path,'result.yml'))
+    if not os.path.exists(module_report_dir_path):
+        os.makedirs(module_report_dir_path)
+    if 'output' not in result:
+        # output was not streamed to the logs, write what we have
+        for stream in ['stdout', 'stderr']:
+            output = result[stream] or b''
+            if not isinstance(output, bytes):
+                output = output.encode('utf-8')
+            with gzip.open(module_log_path(module_report_dir_path, stream), 'wb') as f:
+                f.write(output)
+
+    with open(result_yaml_file_path,'w') as f:
+        f.write(yaml.safe_dump(result, default_flow_style=False))
+
+def log_html_file_name(module, stream, page):
+    # first page keeps the old name, links from index.html point to it
+    if page == 1:
+        return '%s_%s.html' % (module, stream)
+    return '%s_%s_%d.html' % (module, stream, page)
+
+def log_pages(lines, page_lines):
+    """ Split lines to pages of page_lines, yields (page, is_last_page) """
+    page = []
+    for line in lines:
+        if len(page) == page_lines:
+            yield (page, False)
+            page = []
+        page.append(line)
+    yield (page, True)
+
+def render_log_html(log_file_path, report_html_dir_path, module, stream, template_dir, page_lines=5000):
+    """ Convert compressed ANSI log to linked html pages, runs in a ReportWriter worker """
+    from ansi2html import Ansi2HTMLConverter
+    conv = Ansi2HTMLConverter()
+    env = Environment(loader=FileSystemLoader(template_dir), lstrip_blocks=True, trim_blocks=True)
+    template = env.get_template('log.html')
+    log = gzip.open(log_file_path) if os.path.exists(log_file_path) else io.BytesIO()
+    pages = 0
+    with contextlib.closing(log):
+        for (page, is_last_page) in log_pages(log, page_lines):
+            pages += 1
+            input_data = {'module': module, 'stream': stream, 'page': pages,
+                          'style': conv.produce_headers(),
+                          'content': conv.convert(b''.join(page).decode('utf-8', 'replace'), full=False),
+                          'previous_page': log_html_file_name(module, stream, pages - 1) if pages > 1 else None,
+                          'next_page': None if is_last_page else log_html_file_name(module, stream, pages + 1)}
+            html_file_path = os.path.join(report_html_dir_path, log_html_file_name(module, stream, pages))
+            with io.open(html_file_path, 'w', encoding='utf-8') as f:
+                f.write(template.render(input_data))
+    return pages
+
+class ReportWriter:
+    """ Save report of a module as soon as it is finished, logs are converted
+        to html in a pool of worker processes. Index and metrics are written on close.
+    """
+    def __init__(self, reports_dir=os.getcwd(), do_render_html=False, template_dir=None, processes=None, page_lines=5000):
+        self.reports_dir = reports_dir
+        self.do_render_html = do_render_html
+        self.template_dir = template_dir
+        self.page_lines = page_lines
+        self.report_dir_path = os.path.abspath(os.path.join(reports_dir,'reports'))
+        self.report_html_dir_path = os.path.abspath(os.path.join(self.report_dir_path,'html'))
+        # module logs are streamed into the reports dir while tests are running,
+        # so it is cleaned only once at start by clean_reports_dir()
+        if not os.path.exists(self.report_html_dir_path):
+            os.makedirs(self.report_html_dir_path)
+        self._conversions = []
+        self._workers = None
+        if do_render_html:
+            # create it before any thread is started, forked workers get no copy of threads and their locks
+            self._workers = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+
+    def add(self, result, save_module=True):
+        if save_module:
+            results_save_module_report(result, self.reports_dir)
+        if not self.do_render_html:
+            return
+        module = result['puppet_module']
+        for stream in ['stdout', 'stderr']:
+            log_file_path = module_log_path(module_report_dir(self.reports_dir, module), stream)
+            self._conversions.append((module, self._workers.apply_async(render_log_html,
+                (log_file_path, self.report_html_dir_path, module, stream, self.template_dir, self.page_lines))))
+
+    def close(self, results, summary=None):
+        """ summary is a dict of run wide sections saved in summary.yml """
+        logging.info("Reports dir: '%s'" % self.report_dir_path)
+        results_save_metrics(results, self.report_dir_path, summary)
+        with open(os.path.join(self.report_dir_path, 'summary.yml'), 'w') as f:
+            f.write(yaml.safe_dump(summary or {}, default_flow_style=False))
+        if not self.do_render_html:
+            return
+        self._workers.close()
+        for (module, conversion) in self._conversions:
+            try:
+                conversion.get()
+            except Exception as e:
+                logging.error('Can not convert logs of "%s" to html: %s' % (module, e))
+        self._workers.join()
 
-    if do_render_html:
-        from ansi2html import Ansi2HTMLConverter
-        os.makedirs(report_html_dir_path)
         input_data = {}
         input_data['results'] = results
-        result_html_file_path = os.path.abspath(os.path.join(report_html_dir_path,'index.html'))
+        input_data['summary'] = summary or {}
+        input_data['docker_hosts'] = sorted(set([result['docker_host'] for result in results if result.get('docker_host')]))
+        result_html_file_path = os.path.abspath(os.path.join(self.report_html_dir_path,'index.html'))
         with open(result_html_file_path,'w') as f:
-            f.write(template_render(template_dir, 'index.html', input_data))
+            f.write(template_render(self.template_dir, 'index.html', input_data))
+
+def results_save_report(results, reports_dir=os.getcwd(), do_render_html=False, template_dir=None, save_modules=True):
+    #result = {'puppet_module':self.puppet_facter_module, 'task':None, 'retcode':1, 'stdout':None, 'stderr':stderr, 'time':None}
+    report_writer = ReportWriter(reports_dir, do_render_html, template_dir)
+    for result in results:
+        report_writer.add(result, save_module=save_modules)
+    report_writer.close(results)
 
-        conv = Ansi2HTMLConverter()
-        for result in results:
-            stderr_html_file_path = os.path.abspath(os.path.join(report_html_dir_path,'%s_stderr.html' % result['puppet_module']))
-            stdout_html_file_path = os.path.abspath(os.path.join(report_html_dir_path,'%s_stdout.html' % result['puppet_module']))
-            with open(stderr_html_file_path,'w') as f:
-                html = conv.convert(result['stderr'])
-                f.write(html)
-            with open(stdout_html_file_path,'w') as f:
-                html = conv.convert(result['stdout'])
-                f.write(html)
 
+# containers are removed by ContainerReaper after their results are reported,
+# removal time of the whole run is exported from summary['container_removal']
+CONTAINER_PHASES = ['image_check', 'create', 'start', 'ip_assign', 'ssh_ready', 'puppet_apply']
+
+def results_save_metrics(results, report_dir_path, summary=None):
+    """ Export per module phase timings as metrics.json and
+        metrics.prom for the prometheus node exporter textfile collector.
+    """
+    metrics = {}
+    for result in results:
+        metrics[result['puppet_module']] = {'retcode': result['retcode'],
+                                            'puppet_failed': result.get('puppet_failed', True),
+                                            'cached': result.get('cached', False),
+                                            'docker_host': result.get('docker_host'),
+                                            'timings': result.get('timings', {})}
+    with open(os.path.join(report_dir_path, 'metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2, sort_keys=True)
+
+    lines = ['# HELP puppet_test_phase_seconds Duration of a container phase of the module test.',
+             '# TYPE puppet_test_phase_seconds gauge']
+    for module in sorted(metrics):
+        if metrics[module]['cached']:
+            # timings of a cached result belong to an earlier run
+            continue
+        for phase in CONTAINER_PHASES:
+            if phase in metrics[module]['timings']:
+                lines.append('puppet_test_phase_seconds{module="%s",phase="%s"} %f' % (module, phase, metrics[module]['timings'][phase]))
+    lines += ['# HELP puppet_test_module_failed Whether the module test failed.',
+              '# TYPE puppet_test_module_failed gauge']
+    for module in sorted(metrics):
+        lines.append('puppet_test_module_failed{module="%s"} %d' % (module, 1 if metrics[module]['puppet_failed'] else 0))
+    lines += ['# HELP puppet_test_module_cached Whether the module result was reused from the cache.',
+              '# TYPE puppet_test_module_cached gauge']
+    for module in sorted(metrics):
+        lines.append('puppet_test_module_cached{module="%s"} %d' % (module, 1 if metrics[module]['cached'] else 0))
+    removal = (summary or {}).get('container_removal')
+    if removal:
+        lines += ['# HELP puppet_test_container_removal_seconds Time spent removing containers of the run.',
+                  '# TYPE puppet_test_container_removal_seconds gauge',
+                  'puppet_test_container_removal_seconds %f' % removal['seconds'],
+                  '# HELP puppet_test_containers_removed Number of containers removed after their tests.',
+                  '# TYPE puppet_test_containers_removed gauge',
+                  'puppet_test_containers_removed %d' % removal['removed']]
+    # textfile collector may read the file at any time, replace it atomically
+    prom_file_path = os.path.join(report_dir_path, 'metrics.prom')
+    with open(prom_file_path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(prom_file_path + '.tmp', prom_file_path)
+
+def merge_summaries(summaries):
+    """ Summary of merged reports: lists are joined, numbers of dict sections are added up """
+    merged = {}
+    for summary in summaries:
+        for (section, value) in summary.items():
+            if section not in merged:
+                merged[section] = copy.deepcopy(value)
+            elif isinstance(value, list):
+                merged[section] += value
+            elif isinstance(value, dict):
+                for (key, number) in value.items():
+                    if isinstance(number, (int, float)) and isinstance(merged[section].get(key), (int, float)):
+                        merged[section][key] += number
+    return merged
+
+def merge_reports(source_dirs, reports_dir, template_dir, processes=None):
+    """ Combine reports of several runs (e.g. shards) into reports_dir.
+        A module found in several reports keeps its failed result, or the first one.
+        runtimes.yml with the apply time of every module is written for --shard-runtimes.
+    """
+    report_dir_path = os.path.abspath(os.path.join(reports_dir, 'reports'))
+    source_report_dirs = []
+    for source_dir in source_dirs:
+        # accept the --reports-dir of a run as well as its 'reports' directory
+        if os.path.isdir(os.path.join(source_dir, 'reports')):
+            source_dir = os.path.join(source_dir, 'reports')
+        if not os.path.isdir(source_dir):
+            logging.error("Reports dir does not exist: '%s'" % source_dir)
+            return 1
+        source_path = os.path.abspath(source_dir)
+        # reports dir is cleaned before merging, it must not hold any of the merged reports
+        if (source_path == report_dir_path or source_path.startswith(report_dir_path + os.sep)
+                or report_dir_path.startswith(source_path + os.sep)):
+            logging.error("Reports dir '%s' overlaps merged reports '%s', choose another '--reports-dir'" % (report_dir_path, source_dir))
+            return 1
+        source_report_dirs.append(source_dir)
+
+    clean_reports_dir(reports_dir)
+    report_writer = ReportWriter(reports_dir, do_render_html=True, template_dir=template_dir, processes=processes)
+    results = {}
+    summaries = []
+    for source_dir in source_report_dirs:
+        if os.path.exists(os.path.join(source_dir, 'summary.yml')):
+            with open(os.path.join(source_dir, 'summary.yml')) as f:
+                summaries.append(yaml.safe_load(f) or {})
+        for module in sorted(os.listdir(source_dir)):
+            result_yaml_file_path = os.path.join(source_dir, module, 'result.yml')
+            if not os.path.exists(result_yaml_file_path):
+                continue
+            with open(result_yaml_file_path) as f:
+                result = yaml.safe_load(f)
+            if module in results:
+                if results[module]['puppet_failed'] is not False or result.get('puppet_failed') is False:
+                    logging.info('Module "%s" is in several reports, keep result from %s' % (module, results[module]['source']))
+                    continue
+                shutil.rmtree(module_report_dir(reports_dir, module))
+            shutil.copytree(os.path.join(source_dir, module), module_report_dir(reports_dir, module))
+            for stream in ['stdout', 'stderr']:
+                if stream in (result.get('output') or {}):
+                    result['output'][stream]['log'] = module_log_path(module_report_dir(reports_dir, module), stream)
+            results[module] = {'result': result, 'source': source_dir, 'puppet_failed': result.get('puppet_failed', True)}
+
+    runtime_history = RuntimeHistory(os.path.join(report_writer.report_dir_path, 'runtimes.yml'))
+    for module in sorted(results):
+        result = results[module]['result']
+        report_writer.add(result, save_module=False)
+        if result.get('time_seconds') is not None and not result.get('aborted'):
+            runtime_history.record(module, result['time_seconds'])
+    runtime_history.save()
+    merged = [results[module]['result'] for module in sorted(results)]
+    summary = merge_summaries(summaries)
+    summary['merged_reports'] = [os.path.abspath(source_dir) for source_dir in source_dirs]
+    report_writer.close(merged, summary)
+    logging.info('Merged %d module reports of %d runs' % (len(merged), len(source_dirs)))
+    return 0
+
+def module_report_dir(reports_dir, module):
+    return os.path.abspath(os.path.join(reports_dir, 'reports', module))
 
 def clean_reports_dir(reports_dir=os.getcwd()):
     report_dir_path = os.path.abspath(os.path.join(reports_dir,'reports'))
@@ -465,14 +2846,66 @@ if __name__ == '__main__':
     parser.add_argument('--autodetect-modules','-a', dest='autodetect_modules', action='store_true',
             help='search puppet directory to find modules with tests')
 
-    parser.add_argument("--parallel","-p", dest="parallel_jobs", default=1, type=int,
-            help="number of testing jobs to run in parallel")
+    parser.add_argument("--parallel","-p", dest="parallel_jobs", default=1, type=parse_parallel_jobs,
+            help="number of testing jobs to run in parallel or 'auto': one per CPU of the docker host "
+                 "as long as memory used by modules in past runs fits, tests wait while the host is short of memory")
+
+    parser.add_argument("--container-memory", dest="container_memory", metavar='SIZE',
+            help="memory limit of every module test container, e.g. 2g")
+
+    parser.add_argument("--container-cpus", dest="container_cpus", type=int, metavar='N',
+            help="pin every module test container to N CPUs, containers are spread over all CPUs of the docker host")
+
+    parser.add_argument("--docker-url", dest="docker_urls", action='append', metavar='URL[=CAPACITY]',
+            help="docker endpoint to run tests on, CAPACITY defaults to --parallel. "
+                 "Repeat to distribute tests across several docker hosts, "
+                 "puppet directory must be available at the same path on every host "
+                 "(default: unix://var/run/docker.sock)")
+
+    parser.add_argument('--shard', dest='shard', type=parse_shard, metavar='I/N',
+            help='test only shard I of N of the selected modules, every executor has to select the same modules')
+
+    parser.add_argument('--shard-runtimes', dest='shard_runtimes', metavar='FILE',
+            help='balance shards by module runtimes in FILE, e.g. reports/runtimes.yml of the last merged report. '
+                 'Every executor has to use the same file, without it modules are dealt to shards by name')
+
+    parser.add_argument('--merge-reports', dest='merge_reports', nargs='+', metavar='DIR',
+            help='merge reports of several runs (e.g. all shards) into --reports-dir and exit')
+
+    parser.add_argument('--watch', dest='watch', action='store_true',
+            help='keep a container per selected module and apply puppet in it again whenever files under '
+                 'modules/, hieradata/ or manifests/ affecting the module change (uses inotify if pyinotify is installed)')
+
+    parser.add_argument('--pool', dest='container_pool', action='store_true',
+            help='keep containers started from the base image (as many as docker endpoint capacity) and take a fresh one for every module')
 
     parser.add_argument('--skip-base-creation','--quick', dest='skip_base_image', action='store_true',
-            help='do not create base image assuming its already exist, just run modules')
+            help='reuse the latest base image even if base role inputs changed since it was built')
+
+    parser.add_argument('--rebuild-base', dest='rebuild_base_image', action='store_true',
+            help='build base image even if an image with the same inputs fingerprint exists')
 
     parser.add_argument('--leave-base', dest='leave_base_image', action='store_true',
-            help='do not delete base image after tests completed')
+            help='do not remove least recently used base images after tests completed')
+
+    parser.add_argument('--base-images-keep', dest='base_images_keep', default=3, type=int,
+            help='number of fingerprinted base images to keep')
+
+    parser.add_argument('--prescreen', dest='prescreen', action='store_true',
+            help='validate manifests and compile catalog of every module on this host before containers are started, '
+                 'modules failing it are not tested in containers (needs puppet installed)')
+
+    parser.add_argument('--prescreen-processes', dest='prescreen_processes', default=None, type=int,
+            help='number of processes running the pre-screen, number of CPUs by default')
+
+    parser.add_argument('--max-failures', dest='max_failures', default=None, type=int, metavar='N',
+            help='cancel queued and running module tests once N modules failed')
+
+    parser.add_argument('--no-fail-fast', dest='fail_fast', action='store_false',
+            help='let puppet apply run to the end after a fatal error (catalog compilation, dependency cycle) was printed')
+
+    parser.add_argument('--profile', dest='profile', action='store_true',
+            help='trace puppet evaluation time of every resource and report the slowest resources and classes')
 
     parser.add_argument("--puppet-directory", dest="puppet_directory", default='/vagrant',
             help="path of the puppet directory")
@@ -480,11 +2913,51 @@ if __name__ == '__main__':
     parser.add_argument("--docker_rsa_key","--rsa", dest="docker_rsa_key",
             help="path to the RSA key to access docker containers")
 
+    parser.add_argument("--transport", dest="transport", default='exec', choices=sorted(TRANSPORTS),
+            help="run puppet in containers with docker exec or over ssh (image has to run sshd)")
+
     parser.add_argument("--reports-dir", dest="reports_dir", default=os.getcwd(),
             help="directory to store reports")
 
+    parser.add_argument("--report-processes", dest="report_processes", default=None, type=int,
+            help="number of processes converting logs to html, number of CPUs by default")
+
+    parser.add_argument("--state-dir", dest="state_dir", default=os.path.expanduser('~/.puppet_test'),
+            help="directory to keep data between runs (module runtimes, result cache)")
+
+    parser.add_argument("--package-cache", dest="package_cache", action='store_true',
+            help="share yum cache of all containers, kept in the state dir between runs")
+
+    parser.add_argument("--yum-mirror", dest="yum_mirror", metavar='DIR',
+            help="directory with a yum repository preferred over the repositories of the image, implies --package-cache")
+
+    parser.add_argument("--history", dest="show_history", action='store_true',
+            help="print runtime trend of modules (all or selected with -m) recorded in the state dir and exit, "
+                 "exit code is 1 when the last apply of a module regressed")
+
+    parser.add_argument("--history-runs", dest="history_runs", default=10, type=int, metavar='N',
+            help="number of previous runs the apply time of a module is compared with")
+
+    parser.add_argument("--regression-threshold", dest="regression_threshold", default=1.5, type=float,
+            help="apply time over this multiple of the median of previous runs is reported as a regression")
+
+    parser.add_argument("--no-cache", dest="use_cache", action='store_false',
+            help="apply every module, do not reuse cached results of unchanged modules")
+
+    parser.add_argument("--cache-size", dest="cache_size", default=500, type=int,
+            help="number of cached module results to keep")
+
     args = parser.parse_args()
+    run_started = datetime.datetime.now().replace(microsecond=0)
 
+    if args.merge_reports:
+        template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+        sys.exit(merge_reports(args.merge_reports, args.reports_dir, template_dir, args.report_processes))
+
+    if args.show_history:
+        history = RunHistory(os.path.join(args.state_dir, 'history.sqlite'))
+        modules = set(args.puppet_module.split(',')) if args.puppet_module else None
+        sys.exit(history_report(history, modules, runs=args.history_runs, threshold=args.regression_threshold))
 
     if os.path.exists(args.puppet_directory):
         os.chdir(args.puppet_directory)
@@ -492,24 +2965,27 @@ if __name__ == '__main__':
         logging.error("Puppet directory does not exist: '%s', check '--puppet-directory'" % args.puppet_directory)
         sys.exit(1)
 
+    # checked before ReportWriter creates the reports dir
+    if args.reports_dir and not os.path.exists(args.reports_dir):
+        logging.error("Reports dir does not exist: '%s'" % args.reports_dir)
+        sys.exit(1)
+
     clean_reports_dir(args.reports_dir)
 
     template_dir = os.path.join(args.puppet_directory, 'docker/templates')
+    report_writer = ReportWriter(args.reports_dir, do_render_html=True, template_dir=template_dir,
+                                 processes=args.report_processes)
 
     if not args.docker_rsa_key:
         docker_rsa_key_path = os.path.abspath(os.path.join(args.puppet_directory,'docker/docker_rsa'))
     else:
         docker_rsa_key_path = os.path.abspath(os.path.join(args.docker_rsa_key))
 
-    if not os.path.exists(docker_rsa_key_path):
-        logging.error("Can not find Docker RSA key: '%s'" % docker_rsa_key_path)
-        sys.exit(1)
-
-    logging.info("Docker RSA key: '%s'" % docker_rsa_key_path)
-
-    if args.reports_dir and not os.path.exists(args.reports_dir):
-            logging.error("Reports dir does not exist: '%s'" % args.reports_dir)
+    if args.transport == 'ssh':
+        if not os.path.exists(docker_rsa_key_path):
+            logging.error("Can not find Docker RSA key: '%s'" % docker_rsa_key_path)
             sys.exit(1)
+        logging.info("Docker RSA key: '%s'" % docker_rsa_key_path)
 
     if args.puppet_module:
         puppet_facter_module = args.puppet_module
@@ -517,65 +2993,285 @@ if __name__ == '__main__':
     else:
         puppet_modules = []
 
+    dependency_index = PuppetDependencyIndex(args.puppet_directory, os.path.join(args.state_dir, 'dependency_index.json'))
+    dependency_index.update().save()
+
     if args.jenkins_job:
         if not git_is_inside_work_tree():
             logging.error("Working directory is outside a git tree: '%s', check '--puppet-directory'" % os.getcwd())
             sys.exit(1)
-        puppet_modules = [module for module in jenkins_build_puppet_modules_changed() if module in find_puppet_modules(args.puppet_directory)]
+        puppet_modules = sorted(jenkins_build_puppet_modules_affected(dependency_index, find_puppet_modules(args.puppet_directory)))
         logging.info('Puppet modules to test: %s' % puppet_modules)
 
     if not args.puppet_module and not args.jenkins_job and args.autodetect_modules:
         puppet_modules = find_puppet_modules(args.puppet_directory)
 
-    pcontainer = PuppetContainer(docker_image='spil/slc-puppet',
-                                 docker_image_tag='6.5',
-                                 puppet_src_dir=args.puppet_directory,
-                                 rsa_key=docker_rsa_key_path)
-
-    if not pcontainer.docker_client.images('spil/slc-puppet-base'):
-        #base image is missing - build it anyway
-        build_base_image = True
-    elif args.skip_base_image:
-        build_base_image = False
-    else:
-        build_base_image = True
-
-    if args.leave_base_image or args.skip_base_image:
-        remove_base_image = False
-    else:
-        remove_base_image = True
-
-    results = []
-    if build_base_image:
-        # Create base image - will create container, apply puppet base role, and commit container to the docker base image
-        if pcontainer.docker_client.images('spil/slc-puppet-base'):
-            pcontainer.docker_client.remove_image('spil/slc-puppet-base:6.5')
-        pcontainer.remove()
-        result = pcontainer.kick()
-        results.append(result)
-        if int(result['retcode']) in [0, 2]:
-            logging.info('Base puppet container created, commit to the docker image')
-            pcontainer.docker_client.commit(pcontainer.container_name, repository='spil/slc-puppet-base', tag='6.5')
-        else:
-            results_pretty_print(results) # works only with a list of results
-            logging.error('Base puppet container FAILED, check whats wrong with container "puppet_base" ... Bye')
+    if args.shard:
+        (shard, shards) = args.shard
+        if args.shard_runtimes and not os.path.exists(args.shard_runtimes):
+            logging.error("Shard runtimes file does not exist: '%s'" % args.shard_runtimes)
             sys.exit(1)
-        pcontainer.remove()
-
-    pcontainer_list = []
-    for module in puppet_modules:
-        pcontainer = PuppetContainer(docker_image='spil/slc-puppet-base',
+        # runtime history in the state dir differs between executors, shards would overlap
+        shard_runtime_history = RuntimeHistory(args.shard_runtimes)
+        (puppet_modules, loads) = shard_modules(puppet_modules, shard, shards, shard_runtime_history)
+        logging.info('Shard %d/%d: %d modules, expected runtime %.1fs (shards: %s)' % (shard, shards, len(puppet_modules),
+                     loads[shard - 1], ', '.join(['%.1fs' % load for load in loads])))
+
+    prescreen_results = []
+    if args.prescreen and puppet_modules:
+        if not puppet_is_installed():
+            sys.exit(1)
+        for result in prescreen_modules(sorted(puppet_modules), args.puppet_directory, args.prescreen_processes):
+            if result['puppet_failed']:
+                logging.error('Module "%s" failed pre-screen (%s), it will not be tested in a container:' % (
+                              result['puppet_module'], result['prescreen']))
+                logging.error(result['stderr'] or result['stdout'])
+                report_writer.add(result)
+                prescreen_results.append(result)
+            else:
+                logging.info('Module "%s" passed pre-screen in %s' % (result['puppet_module'], result['time']))
+        failed_modules = [result['puppet_module'] for result in prescreen_results]
+        puppet_modules = [module for module in puppet_modules if module not in failed_modules]
+
+    package_cache = None
+    if args.package_cache or args.yum_mirror:
+        if args.yum_mirror and not os.path.exists(os.path.join(args.yum_mirror, 'repodata')):
+            logging.error("Yum mirror is not a yum repository (no 'repodata'): '%s'" % args.yum_mirror)
+            sys.exit(1)
+        package_cache = PackageCache(os.path.join(args.state_dir, 'yum-packages'), args.yum_mirror).setup()
+
+    base_images = BaseImageRegistry(os.path.join(args.state_dir, 'base_images.yml'), keep=args.base_images_keep)
+    docker_endpoints = parse_docker_endpoints(args.docker_urls or ['unix://var/run/docker.sock'], args.parallel_jobs)
+
+    history = RunHistory(os.path.join(args.state_dir, 'history.sqlite'))
+    container_memory = docker.utils.parse_bytes(args.container_memory) if args.container_memory else None
+    footprints = history.memory_footprints()
+    footprint = typical_footprint(footprints, container_memory or DEFAULT_MODULE_MEMORY)
+    auto_parallel = [endpoint for endpoint in docker_endpoints if endpoint.capacity == 'auto']
+    for endpoint in docker_endpoints:
+        if endpoint.capacity == 'auto' or args.container_cpus:
+            endpoint.inspect_resources(get_docker_client(endpoint.base_url))
+        if endpoint.capacity == 'auto':
+            endpoint.capacity = auto_capacity(endpoint.cpus, endpoint.memory, footprint)
+            logging.info('Run %d tests at once on %s: %s CPUs, %sMB of memory, %dMB per module' %
+                         (endpoint.capacity, endpoint.base_url, endpoint.cpus,
+                          endpoint.memory // 2**20 if endpoint.memory else 'unknown', footprint // 2**20))
+    # memory use of modules is measured and watched only when concurrency is sized by it
+    admission = MemoryAdmission(footprints, footprint) if auto_parallel else None
+
+    def prepare_base_image(endpoint, report_name):
+        """ Check base image on the endpoint, build it when its fingerprint changed.
+            Returns result of the base puppet run or None if base image was reused.
+        """
+        pcontainer = PuppetContainer(docker_image='spil/slc-puppet',
                                      docker_image_tag='6.5',
-                                     puppet_facter_module=module,
                                      puppet_src_dir=args.puppet_directory,
+                                     docker_base_url=endpoint.base_url,
+                                     log_dir=module_report_dir(args.reports_dir, report_name),
+                                     transport=args.transport,
+                                     package_cache=package_cache,
                                      rsa_key=docker_rsa_key_path)
-        pcontainer_list.append(pcontainer)
+        docker_client = pcontainer.docker_client
+        endpoint.base_image_tag = base_images.fingerprint_tag(args.puppet_directory, dependency_index.site_modules(),
+                                                              docker_image_id(docker_client, 'spil/slc-puppet:6.5'))
+        logging.info('Base image on %s: %s' % (endpoint.base_url, base_images.image(endpoint.base_image_tag)))
+
+        if args.rebuild_base_image:
+            build_base_image = True
+        elif docker_image_exists(docker_client, base_images.image(endpoint.base_image_tag)):
+            build_base_image = False
+        elif args.skip_base_image and base_images.latest_tag(docker_client):
+            endpoint.base_image_tag = base_images.latest_tag(docker_client)
+            logging.info('Base image inputs changed, reuse the latest base image in quick mode: %s' % base_images.image(endpoint.base_image_tag))
+            build_base_image = False
+        else:
+            build_base_image = True
+
+        result = None
+        if build_base_image:
+            # Create base image - will create container, apply puppet base role, and commit container to the docker base image
+            if docker_image_exists(docker_client, base_images.image(endpoint.base_image_tag)):
+                docker_client.remove_image(base_images.image(endpoint.base_image_tag))
+            pcontainer.remove()
+            result = pcontainer.kick()
+            result['puppet_module'] = report_name
+            result['docker_host'] = endpoint.base_url
+            report_writer.add(result)
+            base_built = int(result['retcode']) in [0, 2]
+            if base_built:
+                logging.info('Base puppet container created on %s, commit to the docker image' % endpoint.base_url)
+                docker_client.commit(pcontainer.container_name, repository=base_images.repository, tag=endpoint.base_image_tag)
+            pcontainer.remove()
+            if not base_built:
+                # image was not committed, report why the base role failed
+                return result
+        endpoint.base_image_id = docker_image_id(docker_client, base_images.image(endpoint.base_image_tag))
+        return result
 
-    p = Pool(int(args.parallel_jobs))
-    results = results + p.map_async(test_container, pcontainer_list).get(timeout=600)
+    # base image is prepared on all docker endpoints at once
+    base_results = [None] * len(docker_endpoints)
+    def prepare_endpoint(index, endpoint):
+        report_name = 'base' if len(docker_endpoints) == 1 else 'base_%d' % index
+        try:
+            base_results[index] = prepare_base_image(endpoint, report_name)
+        except Exception as e:
+            logging.error('Can not prepare base image on %s: %s' % (endpoint.base_url, e))
+            base_results[index] = {'puppet_module':report_name, 'docker_host':endpoint.base_url,
+                                   'task':None, 'retcode':1, 'stdout':'', 'stderr':str(e), 'time':None}
+    preparing = [threading.Thread(target=prepare_endpoint, args=(index, endpoint))
+                 for (index, endpoint) in enumerate(docker_endpoints)]
+    for thread in preparing:
+        thread.start()
+    for thread in preparing:
+        thread.join()
+    # state file of base images is written by the main thread only
+    for endpoint in docker_endpoints:
+        if endpoint.base_image_id:
+            base_images.touch(endpoint.base_image_tag)
+
+    commit = git_head_commit()
+    results = [result for result in base_results if result]
+    if [result for result in results if int(result['retcode']) not in [0, 2]]:
+        history.add_run(results, run_started, commit, docker_endpoints[0].base_image_tag)
+        results_pretty_print(results) # works only with a list of results
+        logging.error('Base puppet container FAILED, check whats wrong with container "puppet_base" ... Bye')
+        sys.exit(1)
+    results = results + prescreen_results
+
+    fatal_re = PUPPET_FATAL_RE if args.fail_fast else None
+    if args.watch:
+        endpoint = docker_endpoints[0]
+        def watch_container_factory(module):
+            return PuppetContainer(docker_image=base_images.repository,
+                                   docker_image_tag=endpoint.base_image_tag,
+                                   puppet_facter_module=module,
+                                   puppet_src_dir=args.puppet_directory,
+                                   docker_base_url=endpoint.base_url,
+                                   log_dir=module_report_dir(args.reports_dir, module),
+                                   profile=args.profile,
+                                   transport=args.transport,
+                                   package_cache=package_cache,
+                                   fatal_re=fatal_re,
+                                   mem_limit=args.container_memory,
+                                   rsa_key=docker_rsa_key_path)
+        watcher = PuppetTreeWatcher(args.puppet_directory)
+        results = results + watch_modules(puppet_modules, watch_container_factory, dependency_index, watcher,
+                                          concurrency=endpoint.capacity, on_result=report_writer.add)
+        report_writer.close(results, {'docker_api': get_docker_api_stats().summary()})
+        sys.exit(0)
+
+    runtime_history = history.runtime_history()
+    puppet_modules = runtime_history.longest_first(puppet_modules)
+    logging.info('Modules in dispatch order: %s' % ', '.join(
+                 ['%s (%.1fs)' % (module, runtime_history.expected(module)) for module in puppet_modules]))
+
+    cache_keys = {}
+    if args.use_cache:
+        result_cache = ResultCache(os.path.join(args.state_dir, 'cache'), max_entries=args.cache_size)
+        # modules may run on any endpoint, key cache by the base image of the first one
+        base_image_id = docker_endpoints[0].base_image_id
+        modules_to_test = []
+        for module in puppet_modules:
+            # result of a run with other limits or another puppet command is not reused
+            puppet_command = PuppetContainer(rsa_key=docker_rsa_key_path, puppet_facter_module=module,
+                                             transport=args.transport, profile=args.profile,
+                                             package_cache=package_cache).prepare_puppet_command()
+            run_options = {'puppet_command': puppet_command, 'transport': args.transport,
+                           'yum_mirror': package_cache.mirror_dir if package_cache else None,
+                           'container_memory': args.container_memory, 'container_cpus': args.container_cpus}
+            cache_keys[module] = result_cache.key(module, args.puppet_directory, base_image_id,
+                                                  dependency_index.dependencies_closure([module]), run_options)
+            result = result_cache.get(cache_keys[module], module_report_dir(args.reports_dir, module))
+            if result:
+                logging.info('Module "%s" did not change, reuse cached result' % module)
+                report_writer.add(result)
+                results.append(result)
+            else:
+                modules_to_test.append(module)
+        puppet_modules = modules_to_test
+
+    def on_result(result):
+        logging.info('Module "%s" finished: retcode %s' % (result['puppet_module'], result['retcode']))
+        report_writer.add(result)
+        if result['puppet_module'] in cache_keys and result.get('puppet_failed') is False:
+            result_cache.put(cache_keys[result['puppet_module']], result,
+                             module_report_dir(args.reports_dir, result['puppet_module']))
+
+    if args.container_pool:
+        budget = ContainerBudget(len(puppet_modules))
+        for (index, endpoint) in enumerate(docker_endpoints):
+            def pool_container_factory(container_name, endpoint=endpoint):
+                return PuppetContainer(docker_image=base_images.repository,
+                                       docker_image_tag=endpoint.base_image_tag,
+                                       container_name=container_name,
+                                       puppet_src_dir=args.puppet_directory,
+                                       docker_base_url=endpoint.base_url,
+                                       profile=args.profile,
+                                       transport=args.transport,
+                                       package_cache=package_cache,
+                                       fatal_re=fatal_re,
+                                       mem_limit=args.container_memory,
+                                       cpuset=endpoint.next_cpuset(args.container_cpus) if args.container_cpus else None,
+                                       measure_memory=bool(admission),
+                                       rsa_key=docker_rsa_key_path)
+            endpoint.container_pool = ContainerPool(endpoint.capacity, budget, pool_container_factory,
+                                                    name_prefix='puppet_pool_%d' % index)
+            endpoint.container_pool.start()
+
+        def test_module(endpoint, module):
+            return test_pool_module(endpoint.container_pool, module, module_report_dir(args.reports_dir, module))
+    else:
+        def test_module(endpoint, module):
+            pcontainer = PuppetContainer(docker_image=base_images.repository,
+                                         docker_image_tag=endpoint.base_image_tag,
+                                         puppet_facter_module=module,
+                                         puppet_src_dir=args.puppet_directory,
+                                         docker_base_url=endpoint.base_url,
+                                         log_dir=module_report_dir(args.reports_dir, module),
+                                         profile=args.profile,
+                                         transport=args.transport,
+                                         package_cache=package_cache,
+                                         fatal_re=fatal_re,
+                                         mem_limit=args.container_memory,
+                                         cpuset=endpoint.next_cpuset(args.container_cpus) if args.container_cpus else None,
+                                         measure_memory=bool(admission),
+                                         rsa_key=docker_rsa_key_path)
+            return test_container(pcontainer)
+
+    balancer = EndpointBalancer(docker_endpoints)
+    tasks = [(module, functools.partial(test_on_endpoint, balancer, test_module, module, admission)) for module in puppet_modules]
+    scheduler = TestScheduler(sum([endpoint.capacity for endpoint in docker_endpoints]), on_result=on_result,
+                              max_failures=args.max_failures, on_cancel=get_lifetime_watchdog().cancel)
+    results = results + scheduler.run(tasks)
+    if args.container_pool:
+        for endpoint in docker_endpoints:
+            endpoint.container_pool.close()
+    get_container_reaper().close()
+    if args.use_cache:
+        logging.info('Result cache: %d hits, %d misses' % (result_cache.hits, result_cache.misses))
+        result_cache.evict()
     results_pretty_print(results)
-    results_save_report(results, args.reports_dir, do_render_html=True, template_dir=template_dir)
-
-    if remove_base_image:
-        logging.info('All test complete - remove base image')
-        pcontainer.docker_client.remove_image('spil/slc-puppet-base:6.5')
+    summary = {}
+    run_id = history.add_run(results, run_started, commit, docker_endpoints[0].base_image_tag)
+    tested_modules = set([result['puppet_module'] for result in results
+                          if result.get('time_seconds') is not None and not result.get('cached')])
+    summary['regressions'] = []
+    if tested_modules:
+        runtimes = history.runtimes(tested_modules, runs=args.history_runs + 1)
+        summary['regressions'] = [regression for regression in runtime_regressions(runtimes, threshold=args.regression_threshold)
+                                  if regression['run'] == run_id]
+    for regression in summary['regressions']:
+        logging.warning('Module "%(module)s" became slower: %(time_seconds).1fs, median of previous runs %(median).1fs' % regression)
+    if package_cache:
+        summary['package_cache'] = package_cache.stats(results)
+        logging.info('Package cache: %(packages_installed)d packages installed, %(packages_downloaded)d downloaded, '
+                     '%(packages_cached)d in the cache' % summary['package_cache'])
+    summary['container_removal'] = get_container_reaper().stats()
+    summary['docker_api'] = get_docker_api_stats().summary()
+    logging.info('Docker API: %d calls, %d failed, %.1fs' % (sum([call['count'] for call in summary['docker_api']]),
+                 sum([call['errors'] for call in summary['docker_api']]), sum([call['seconds'] for call in summary['docker_api']])))
+    report_writer.close(results, summary)
+
+    if not args.leave_base_image:
+        for endpoint in docker_endpoints:
+            base_images.collect_garbage(get_docker_client(endpoint.base_url), endpoint.base_image_tag)